@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from collections import namedtuple
+
+BatchResult = namedtuple('BatchResult',
+                         'index method url response exception')
+
+_DONE = object()
+
+
+def parse_spec(spec):
+    if isinstance(spec, dict):
+        kwargs = dict(spec)
+        return kwargs.pop('method'), kwargs.pop('url'), kwargs
+
+    if len(spec) == 3:
+        method, url, kwargs = spec
+        return method, url, dict(kwargs)
+
+    method, url = spec
+    return method, url, {}
+
+
+class _SpecSource(object):
+
+    def __init__(self, requests):
+        self._index = -1
+        if hasattr(requests, '__aiter__'):
+            self._iterator = requests.__aiter__()
+            self._lock = asyncio.Lock()
+        else:
+            self._iterator = iter(requests)
+            self._lock = None
+
+    async def next(self):
+        if self._lock is None:
+            spec = next(self._iterator, _DONE)
+        else:
+            # Async generators can not be advanced by two workers at once.
+            async with self._lock:
+                try:
+                    spec = await self._iterator.__anext__()
+                except StopAsyncIteration:
+                    spec = _DONE
+
+        if spec is _DONE:
+            return None, _DONE
+        self._index += 1
+        return self._index, spec
+
+
+async def _worker(request, source, results, read):
+    try:
+        while True:
+            index, spec = await source.next()
+            if spec is _DONE:
+                break
+
+            method, url, kwargs = parse_spec(spec)
+            try:
+                response = await request(method, url, **kwargs)
+                if read:
+                    await response.read()
+            except asyncio.CancelledError:
+                # An Exception before Python 3.8; a cancelled worker must
+                # stop instead of queueing it as a result.
+                raise
+            except Exception as e:
+                result = BatchResult(index, method, url, None, e)
+            else:
+                result = BatchResult(index, method, url, response, None)
+            await results.put(result)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        await results.put(e)
+    else:
+        await results.put(_DONE)
+
+
+async def run_batch(request, requests, concurrency=10, read=True):
+    # A fixed pool of workers pulls specs as it goes, so neither the specs
+    # nor one task per request are materialised up front, and the bounded
+    # queue stops the workers when the consumer falls behind.
+    source = _SpecSource(requests)
+    results = asyncio.Queue(maxsize=concurrency)
+    workers = [asyncio.ensure_future(_worker(request, source, results, read))
+               for _ in range(concurrency)]
+
+    try:
+        running = len(workers)
+        while running:
+            result = await results.get()
+            if result is _DONE:
+                running -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
+    finally:
+        for worker in workers:
+            worker.cancel()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import io
+
+from multidict import CIMultiDict
+
+DEFAULT_REPLAY_BUFFER_SIZE = 64 * 1024
+
+REPLAYABLE_TYPES = (bytes, bytearray, str, dict, list, tuple)
+
+
+class RequestBody(object):
+
+    def can_replay(self):
+        return True
+
+    def rewind(self):
+        pass
+
+
+class _NotReplayableBody(RequestBody):
+
+    def can_replay(self):
+        return False
+
+
+class _SeekableBody(RequestBody):
+
+    def __init__(self, file):
+        self._file = file
+        self._position = file.tell()
+
+    def can_replay(self):
+        # aiohttp closes file bodies once it has sent them.
+        return not self._file.closed
+
+    def rewind(self):
+        self._file.seek(self._position)
+
+
+class StreamingBody(RequestBody):
+
+    def __init__(self, chunks, iterator):
+        self._chunks = chunks
+        self._iterator = iterator
+        self.started = False
+
+    def can_replay(self):
+        return not self.started
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        self.started = True
+        for chunk in self._chunks:
+            yield chunk
+        async for chunk in self._iterator:
+            yield chunk
+
+
+def _remaining(file):
+    position = file.tell()
+    end = file.seek(0, io.SEEK_END)
+    file.seek(position)
+    return end - position
+
+
+def _is_seekable(file):
+    try:
+        return file.seekable()
+    except (AttributeError, ValueError, io.UnsupportedOperation):
+        return False
+
+
+async def prepare_body(kwargs, buffer_size=DEFAULT_REPLAY_BUFFER_SIZE):
+    data = kwargs.get('data')
+    if data is None or isinstance(data, REPLAYABLE_TYPES):
+        return RequestBody()
+
+    if hasattr(data, 'read'):
+        if not _is_seekable(data):
+            return _NotReplayableBody()
+        if _remaining(data) <= buffer_size:
+            kwargs['data'] = data.read()
+            return RequestBody()
+        _expect_continue(kwargs)
+        return _SeekableBody(data)
+
+    if not hasattr(data, '__aiter__'):
+        return _NotReplayableBody()
+
+    # Small streams are buffered so they can be sent again; larger ones
+    # keep streaming and wait for "100 Continue" before the body goes out,
+    # so a 401 leaves them untouched and ready for the retry.
+    iterator = data.__aiter__()
+    chunks = []
+    size = 0
+    while size <= buffer_size:
+        try:
+            chunk = await iterator.__anext__()
+        except StopAsyncIteration:
+            kwargs['data'] = b''.join(chunks)
+            return RequestBody()
+        chunks.append(chunk)
+        size += len(chunk)
+
+    body = StreamingBody(chunks, iterator)
+    kwargs['data'] = body
+    _expect_continue(kwargs)
+    return body
+
+
+def _expect_continue(kwargs):
+    kwargs.setdefault('expect100', True)
+    # A connection that got an early final response without the body can
+    # not be reused, and aiohttp would put it back in the pool.
+    headers = CIMultiDict(kwargs.get('headers') or {})
+    headers.setdefault('Connection', 'close')
+    kwargs['headers'] = headers
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+from aiohttp import ClientResponseError, RequestInfo
+from aiohttp.helpers import parse_mimetype
+from multidict import CIMultiDict, CIMultiDictProxy, MultiDict
+from yarl import URL
+
+from aioalf.manager import scope_key, secret_digest
+from aioalf.storage import private_directory
+
+CACHEABLE_METHODS = ('GET', 'HEAD')
+CACHEABLE_STATUSES = (200, 203, 300, 301, 404, 410)
+NOT_MODIFIED = 304
+# The body is stored decoded, so these no longer describe it.
+_BODY_HEADERS = ('Content-Encoding', 'Content-Length', 'Transfer-Encoding')
+
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in (value or '').split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def _seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _http_date(value):
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def request_url(url, params=None):
+    # The same merge aiohttp does, so the key is the url actually sent.
+    url = URL(url)
+    if params:
+        query = MultiDict(url.query)
+        query.extend(url.with_query(params).query)
+        url = url.with_query(query)
+    return str(url)
+
+
+def credential_identity(token_endpoint, client_id, client_secret,
+                        scope=None):
+    # A hit is served without a token, so the secret has to be part of it.
+    return '%s %s %s %s' % (token_endpoint, client_id,
+                            secret_digest(client_secret),
+                            ' '.join(scope_key(scope) or ()))
+
+
+class CacheEntry(object):
+
+    __slots__ = ('status', 'reason', 'headers', 'body', 'vary',
+                 'response_time')
+
+    def __init__(self, status, headers, body, vary=None, reason=None,
+                 response_time=None):
+        self.status = status
+        self.reason = reason
+        self.headers = CIMultiDict(headers)
+        self.body = body
+        self.vary = vary or {}
+        self.response_time = (time.time() if response_time is None
+                              else response_time)
+
+    @classmethod
+    def from_response(cls, response, body, request_headers, response_time):
+        headers = CIMultiDict(response.headers)
+        # A HEAD response's headers describe the body a GET would return.
+        if response.method != 'HEAD':
+            for name in _BODY_HEADERS:
+                headers.popall(name, None)
+            headers['Content-Length'] = str(len(body))
+        vary = {}
+        for name in headers.get('Vary', '').split(','):
+            name = name.strip().lower()
+            if name:
+                vary[name] = request_headers.get(name)
+        return cls(response.status, headers, body, vary=vary,
+                   reason=response.reason, response_time=response_time)
+
+    @property
+    def size(self):
+        header_size = sum(len(name) + len(value)
+                          for name, value in self.headers.items())
+        return len(self.body) + header_size
+
+    @property
+    def cache_control(self):
+        return parse_cache_control(self.headers.get('Cache-Control'))
+
+    def freshness_lifetime(self):
+        max_age = _seconds(self.cache_control.get('max-age'))
+        if max_age is not None:
+            return max_age
+        expires = _http_date(self.headers.get('Expires'))
+        if expires is None:
+            return 0
+        date = _http_date(self.headers.get('Date')) or self.response_time
+        return max(0, expires - date)
+
+    def age(self, now):
+        initial_age = _seconds(self.headers.get('Age')) or 0
+        return initial_age + max(0, now - self.response_time)
+
+    def is_fresh(self, now):
+        if 'no-cache' in self.cache_control:
+            return False
+        return self.freshness_lifetime() > self.age(now)
+
+    def validators(self):
+        validators = {}
+        if 'ETag' in self.headers:
+            validators['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            validators['If-Modified-Since'] = self.headers['Last-Modified']
+        return validators
+
+    def matches(self, request_headers):
+        return all(request_headers.get(name) == value
+                   for name, value in self.vary.items())
+
+    def revalidated(self, response, response_time):
+        # A 304 carries the headers that changed, such as a new max-age.
+        for name in ('Cache-Control', 'Expires', 'Date', 'ETag',
+                     'Last-Modified', 'Age'):
+            if name in response.headers:
+                self.headers[name] = response.headers[name]
+            elif name == 'Age':
+                self.headers.pop(name, None)
+        self.response_time = response_time
+
+    def response(self, method, url, now):
+        headers = CIMultiDict(self.headers)
+        headers['Age'] = str(int(self.age(now)))
+        return CachedResponse(method, url, self.status, headers, self.body,
+                              reason=self.reason)
+
+    def dump(self):
+        return {
+            'status': self.status,
+            'reason': self.reason,
+            'headers': list(self.headers.items()),
+            'vary': self.vary,
+            'response_time': self.response_time,
+        }
+
+    @classmethod
+    def load(cls, data, body):
+        return cls(data['status'], data['headers'], body, vary=data['vary'],
+                   reason=data['reason'], response_time=data['response_time'])
+
+
+class CachedResponse(object):
+
+    from_cache = True
+
+    def __init__(self, method, url, status, headers, body, reason=None):
+        self.method = method
+        self.url = URL(url)
+        self.status = status
+        self.reason = reason
+        self.headers = CIMultiDictProxy(CIMultiDict(headers))
+        self.request_info = RequestInfo(self.url, method,
+                                        CIMultiDictProxy(CIMultiDict()))
+        self.history = ()
+        self._body = body
+
+    @property
+    def ok(self):
+        return self.status < 400
+
+    @property
+    def content_type(self):
+        return parse_mimetype(self.headers.get('Content-Type', '')).type
+
+    def get_encoding(self):
+        mimetype = parse_mimetype(self.headers.get('Content-Type', ''))
+        return mimetype.parameters.get('charset') or 'utf-8'
+
+    async def read(self):
+        return self._body
+
+    async def text(self, encoding=None, errors='strict'):
+        return self._body.decode(encoding or self.get_encoding(), errors)
+
+    async def json(self, encoding=None, loads=json.loads, content_type=None):
+        return loads(await self.text(encoding))
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise ClientResponseError(self.request_info, self.history,
+                                      status=self.status, message=self.reason,
+                                      headers=self.headers)
+
+    def release(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        pass
+
+
+class BaseCacheBackend(object):
+
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def set(self, key, entry):
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+
+class MemoryCacheBackend(BaseCacheBackend):
+
+    def __init__(self, max_size=32 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, key):
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        self._entries.move_to_end(key)
+        return item[0]
+
+    async def set(self, key, entry):
+        # Sizes are kept at insertion: a revalidated entry is the same
+        # object, with headers already updated.
+        await self.delete(key)
+        size = entry.size
+        if size > self.max_size:
+            return
+        self._entries[key] = (entry, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    async def delete(self, key):
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+
+class DiskCacheBackend(BaseCacheBackend):
+
+    # One file per entry: a line of JSON metadata followed by the body.
+    # Reads touch the file, so the oldest mtime is the least recently used.
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        self.directory = private_directory(os.path.expanduser(directory))
+        self.max_size = max_size
+
+    async def get(self, key):
+        return await self._run(self._read, self._path(key))
+
+    async def set(self, key, entry):
+        await self._run(self._write, self._path(key), entry)
+
+    async def delete(self, key):
+        await self._run(self._remove, self._path(key))
+
+    @staticmethod
+    async def _run(function, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, function, *args)
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as cache_file:
+                data = json.loads(cache_file.readline().decode('utf-8'))
+                body = cache_file.read()
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return CacheEntry.load(data, body)
+
+    def _write(self, path, entry):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(json.dumps(entry.dump()).encode('utf-8'))
+                cache_file.write(b'\n')
+                cache_file.write(entry.body)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        if self.max_size is not None:
+            self._evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+
+class ResponseCache(object):
+
+    def __init__(self, backend=None, clock=time.time, instrumentation=None):
+        self.backend = backend or MemoryCacheBackend()
+        self._clock = clock
+        self._instrumentation = instrumentation
+
+    @staticmethod
+    def key(identity, method, url):
+        return '%s\n%s\n%s' % (identity, method, url)
+
+    async def fetch(self, send, identity, method, url, **kwargs):
+        method = method.upper()
+        if method not in CACHEABLE_METHODS:
+            response = await send(method, url, **kwargs)
+            if response.status < 400:
+                await self.invalidate(identity, url, kwargs.get('params'))
+            return response
+
+        request_headers = CIMultiDict(kwargs.get('headers') or {})
+        directives = parse_cache_control(request_headers.get('Cache-Control'))
+        has_body = kwargs.get('data') is not None or 'json' in kwargs
+        if has_body or 'no-store' in directives:
+            return await send(method, url, **kwargs)
+
+        key = self.key(identity, method,
+                       request_url(url, kwargs.get('params')))
+        entry = await self.backend.get(key)
+        if entry is not None and not entry.matches(request_headers):
+            entry = None
+
+        now = self._clock()
+        if entry is not None and self._usable(entry, directives, now):
+            self._record(method, url, 'hit')
+            return entry.response(method, url, now)
+
+        if entry is not None and entry.validators():
+            headers = CIMultiDict(request_headers)
+            for name, value in entry.validators().items():
+                headers.setdefault(name, value)
+            kwargs['headers'] = headers
+
+        response = await send(method, url, **kwargs)
+        response_time = self._clock()
+
+        if response.status == NOT_MODIFIED and entry is not None:
+            response.release()
+            entry.revalidated(response, response_time)
+            await self.backend.set(key, entry)
+            self._record(method, url, 'revalidated')
+            return entry.response(method, url, response_time)
+
+        self._record(method, url, 'miss')
+        if self._storable(response):
+            body = await response.read()
+            await self.backend.set(key, CacheEntry.from_response(
+                response, body, request_headers, response_time))
+        elif entry is not None:
+            await self.backend.delete(key)
+        return response
+
+    async def invalidate(self, identity, url, params=None):
+        url = request_url(url, params)
+        for method in CACHEABLE_METHODS:
+            await self.backend.delete(self.key(identity, method, url))
+
+    def _usable(self, entry, directives, now):
+        if 'no-cache' in directives or not entry.is_fresh(now):
+            return False
+        max_age = _seconds(directives.get('max-age', ''))
+        return max_age is None or entry.age(now) <= max_age
+
+    def _storable(self, response):
+        if response.status not in CACHEABLE_STATUSES:
+            return False
+        directives = parse_cache_control(response.headers.get('Cache-Control'))
+        if 'no-store' in directives:
+            return False
+        if response.headers.get('Vary', '').strip() == '*':
+            return False
+        if 'max-age' in directives:
+            return True
+        return any(name in response.headers
+                   for name in ('Expires', 'ETag', 'Last-Modified'))
+
+    def _record(self, method, url, outcome):
+        if self._instrumentation is not None:
+            self._instrumentation.on_response_cache.send(
+                method=method, url=url, outcome=outcome)
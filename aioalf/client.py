@@ -1,75 +1,303 @@
 #
 # encoding: utf-8
+import inspect
 import logging
+import re
+import time
+from functools import partial
 
-from aiohttp import ClientSession
-from aioalf.manager import TokenManager, TokenError
-from aioalf.token import TOKEN_FILTER
+from aiohttp import ClientSession, TCPConnector
+from multidict import CIMultiDict, CIMultiDictProxy
+from aioalf.batch import run_batch
+from aioalf.cache import credential_identity
+from aioalf.body import prepare_body, DEFAULT_REPLAY_BUFFER_SIZE
+from aioalf.manager import TokenManager
+from aioalf.registry import default_registry
+from aioalf.token import log_request
 
 BAD_TOKEN = 401
 
 logger = logging.getLogger(__name__)
 
 
+_AUTH_PARAM = re.compile(
+    r'([^\s=,]+)(?:\s*=\s*("(?:[^"\\]|\\.)*"|[^\s,]*))?')
+_QUOTED_PAIR = re.compile(r'\\(.)')
+
+
+def _sent_token(response):
+    authorization = response.request_info.headers.get('Authorization', '')
+    return authorization[len('Bearer '):] or None
+
+
+def _accepts_argument(factory, name):
+    try:
+        parameters = inspect.signature(factory).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    for parameter in parameters:
+        if parameter.kind == inspect.Parameter.VAR_KEYWORD:
+            return True
+        if parameter.name == name:
+            return True
+    return False
+
+
+def _host_name(key):
+    # ConnectionKey since aiohttp 3.0, a (host, port, ssl) tuple before.
+    host = getattr(key, 'host', None)
+    if host is None:
+        return '%s:%s' % tuple(key[:2])
+    return '%s:%s' % (host, key.port)
+
+
+async def _free_connection(response):
+    # A body that has already arrived is read, so a 401 returned without
+    # a retry can still be read; one still streaming is dropped.
+    if response.content.is_eof():
+        await response.read()
+    else:
+        response.release()
+
+
+def parse_www_authenticate(value):
+    challenges = {}
+    params = None
+    for name, param in _AUTH_PARAM.findall(value):
+        if not param:
+            params = challenges.setdefault(name.lower(), {})
+        elif params is not None:
+            if param.startswith('"'):
+                param = _QUOTED_PAIR.sub(r'\1', param[1:-1])
+            params[name.lower()] = param
+    return challenges
+
+
+def is_token_rejected(response):
+    # RFC 6750: a Bearer challenge without an error means the token was
+    # missing, any error other than invalid_token is not about the token.
+    header = response.headers.get('WWW-Authenticate')
+    if not header:
+        return True
+    challenge = parse_www_authenticate(header).get('bearer')
+    if challenge is None:
+        return True
+    return challenge.get('error', 'invalid_token') == 'invalid_token'
+
+
 class Client(object):
 
     token_manager_class = TokenManager
+    token_manager_registry = default_registry
 
     def __init__(self, client_id, client_secret,
                  token_endpoint, http_options=None,
-                 scope=None):
+                 scope=None, share_session=True, shared_token=False,
+                 replay_buffer_size=DEFAULT_REPLAY_BUFFER_SIZE,
+                 connector=None, connector_options=None,
+                 instrumentation=None, refresh_on_401=is_token_rejected,
+                 rate_limiter=None, cache=None):
         http_options = http_options is None and {} or http_options
-        self._http_client = ClientSession()
-        self._token_manager = self.token_manager_class(
-            token_endpoint=token_endpoint,
-            client_id=client_id,
-            client_secret=client_secret,
-            http_options=http_options,
-            scope=scope)
+        self._refresh_on_401 = refresh_on_401
+        self._rate_limiter = rate_limiter
+        self._cache = cache
+        self._token_endpoint = token_endpoint
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._scope = scope
+        self._instrumentation = instrumentation
+        self._replay_buffer_size = replay_buffer_size
+        # A connector passed in may be shared with other clients, so only
+        # one built here from connector_options is closed with the session.
+        connector_owner = connector is None
+        if connector is None and connector_options:
+            connector = TCPConnector(**connector_options)
+        self._http_client = ClientSession(connector=connector,
+                                          connector_owner=connector_owner)
+        self._shared_token = shared_token
+        self._closed = False
+        self._bearer_token = None
+        self._bearer_headers = None
+        manager_options = {}
+        if instrumentation is not None:
+            manager_options['instrumentation'] = instrumentation
+        if shared_token:
+            # Shared managers outlive this client, so they keep their own
+            # session instead of borrowing ours.
+            self._token_manager = self.token_manager_registry.acquire(
+                self.token_manager_class,
+                token_endpoint=token_endpoint,
+                client_id=client_id,
+                client_secret=client_secret,
+                http_options=http_options,
+                scope=scope,
+                **manager_options)
+        else:
+            # Managers written before sessions were shared keep their own.
+            manager_class = self.token_manager_class
+            if share_session and _accepts_argument(manager_class, 'session'):
+                manager_options['session'] = self._http_client
+            self._token_manager = manager_class(
+                token_endpoint=token_endpoint,
+                client_id=client_id,
+                client_secret=client_secret,
+                http_options=http_options,
+                scope=scope,
+                **manager_options)
 
     async def close(self):
+        # A shared manager is counted once per client, so a second close
+        # must not release it again.
+        if self._closed:
+            return
+        self._closed = True
+        if self._shared_token:
+            await self.token_manager_registry.release(self._token_manager)
+        else:
+            await self._token_manager.close()
         await self._http_client.close()
 
+    def pool_stats(self):
+        connector = self._http_client.connector
+        stats = {
+            'limit': getattr(connector, 'limit', None),
+            'limit_per_host': getattr(connector, 'limit_per_host', None),
+            'acquired': None,
+            'idle': None,
+            'open': None,
+            'hosts': {},
+        }
+        # aiohttp has no public API for these counts; connectors whose
+        # internals differ only report their limits.
+        idle_by_host = getattr(connector, '_conns', None)
+        acquired_by_host = getattr(connector, '_acquired_per_host', None)
+        acquired = getattr(connector, '_acquired', None)
+        if None in (idle_by_host, acquired_by_host, acquired):
+            return stats
+
+        hosts = stats['hosts']
+
+        def host_stats(key):
+            return hosts.setdefault(_host_name(key),
+                                    {'acquired': 0, 'idle': 0})
+
+        for key, connections in idle_by_host.items():
+            host_stats(key)['idle'] += len(connections)
+        for key, connections in acquired_by_host.items():
+            host_stats(key)['acquired'] += len(connections)
+
+        idle = sum(host['idle'] for host in hosts.values())
+        stats.update(acquired=len(acquired), idle=idle,
+                     open=len(acquired) + idle)
+        return stats
+
     async def request(self, method, url, **kwargs):
+        if self._instrumentation is None:
+            return await self._request(method, url, **kwargs)
+
+        started = time.perf_counter()
+        status = error = None
         try:
-            response = await self._authorized_fetch(method,
-                                                    url,
-                                                    **kwargs)
-            if response.status != BAD_TOKEN:
-                return response
-
-            await self._token_manager.reset_token()
-            response = await self._authorized_fetch(method,
-                                                    url,
-                                                    **kwargs)
+            response = await self._request(method, url, **kwargs)
+            status = response.status
             return response
-
-        except TokenError:
-            await self._token_manager.reset_token()
+        except Exception as e:
+            error = e
             raise
+        finally:
+            self._instrumentation.on_request_end.send(
+                method=method, url=url, status=status,
+                duration=time.perf_counter() - started, error=error)
+
+    async def _request(self, method, url, **kwargs):
+        token_manager = self._token_manager
+        scope = kwargs.pop('scope', None)
+        if scope is not None:
+            token_manager = token_manager.for_scope(scope)
 
-    async def _authorized_fetch(self, method, url, **kwargs):
-        access_token = await self._token_manager.get_token()
+        if self._cache is None:
+            return await self._send(method, url, token_manager, **kwargs)
 
-        auth_headers = {'Authorization': 'Bearer {}'.format(access_token)}
-        if 'headers' in kwargs:
-            kwargs['headers'].update(auth_headers)
+        # Cached responses are only shared by requests made with the same
+        # credentials and scope.
+        identity = credential_identity(self._token_endpoint, self._client_id,
+                                       self._client_secret,
+                                       scope or self._scope)
+        send = partial(self._send, token_manager=token_manager)
+        return await self._cache.fetch(send, identity, method, url, **kwargs)
+
+    async def _send(self, method, url, token_manager, **kwargs):
+        # A TokenError is raised as is: get_token has just tried to fetch a
+        # token, and shares that attempt with every caller waiting on it.
+        body = await prepare_body(kwargs, self._replay_buffer_size)
+        response = await self._authorized_fetch(
+            method, url, token_manager=token_manager, **kwargs)
+        if response.status != BAD_TOKEN:
+            return response
+        if not self._refresh_on_401(response):
+            return response
+
+        # The refresh may need this connection's slot in the pool.
+        await _free_connection(response)
+        # Managers that predate the result return None, and still retry.
+        # A body that can't be replayed still gets the token refreshed for
+        # the requests that follow.
+        refreshed = await token_manager.reset_token(_sent_token(response))
+        if refreshed is False or not body.can_replay():
+            return response
+
+        if self._instrumentation is not None:
+            self._instrumentation.on_bad_token_retry.send(method=method,
+                                                          url=url)
+
+        body.rewind()
+        return await self._authorized_fetch(
+            method, url, token_manager=token_manager, **kwargs)
+
+    async def request_many(self, requests, concurrency=10, read=True):
+        # One token for the whole batch; 401s inside it are coalesced by
+        # the token manager.
+        await self._token_manager.get_token()
+        async for result in run_batch(self.request, requests,
+                                      concurrency=concurrency, read=read):
+            yield result
+
+    def _auth_headers(self, access_token):
+        # Built once per token and shared read-only by every request that
+        # has no headers of its own.
+        if access_token is not self._bearer_token:
+            self._bearer_token = access_token
+            self._bearer_headers = CIMultiDictProxy(
+                CIMultiDict(Authorization='Bearer %s' % access_token))
+        return self._bearer_headers
+
+    async def _authorized_fetch(self, method, url, token_manager=None,
+                                **kwargs):
+        if token_manager is None:
+            token_manager = self._token_manager
+        access_token = await token_manager.get_token()
+
+        auth_headers = self._auth_headers(access_token)
+        if kwargs.get('headers'):
+            headers = CIMultiDict(kwargs['headers'])
+            headers.update(auth_headers)
+            kwargs['headers'] = headers
         else:
             kwargs['headers'] = auth_headers
 
-        logger.debug('Request: %s %s', method, url)
-        for header in kwargs.get('headers'):
-            if header.lower() == 'authorization':
-                authorization_data = kwargs.get('headers', {}).get(header)
-                matches = TOKEN_FILTER.match(authorization_data)
-                if matches:
-                    logger.debug(('Header {}: {}<...>{}').format(header,
-                                                                 matches.group('start'),
-                                                                 matches.group('end')))
-                continue
-            logger.debug('Header %s: %s', header, kwargs.get('headers').get(header))
-
-        return await self._http_client.request(method, url, **kwargs)
+        log_request(logger, method, url, kwargs['headers'])
+
+        if self._rate_limiter is None:
+            return await self._http_client.request(method, url, **kwargs)
+
+        limit = self._rate_limiter.limit(method, url)
+        await limit.acquire()
+        try:
+            response = await self._http_client.request(method, url, **kwargs)
+        finally:
+            limit.release()
+        self._rate_limiter.observe(limit, response)
+        return response
 
     def __enter__(self):
         raise TypeError("Use async with instead.")
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import secrets
+import webbrowser
+from base64 import urlsafe_b64encode
+from urllib.parse import urlencode
+
+from aioalf.implicit_manager import CallbackServer
+from aioalf.manager import FORM_CONTENT_TYPE, TokenManager
+
+
+def make_pkce_pair():
+    verifier = secrets.token_urlsafe(64)
+    digest = hashlib.sha256(verifier.encode('ascii')).digest()
+    challenge = urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+    return verifier, challenge
+
+
+class OAuthAuthorizationCodeTokenManager(TokenManager):
+
+    def __init__(self, token_endpoint, client_id, client_secret,
+                 http_options=None, scope=None, authorize_endpoint=None,
+                 callback_server=None, port_range=(32000, 32009), **kwargs):
+        super().__init__(token_endpoint, client_id, client_secret,
+                         http_options=http_options, scope=scope, **kwargs)
+        self._authorize_endpoint = authorize_endpoint or (
+            token_endpoint.rsplit('/', 1)[0] + '/authorize')
+        self.callback_server = callback_server
+        self._owns_callback_server = callback_server is None
+        self._port_range = port_range
+
+    async def close(self):
+        await super().close()
+        if self._owns_callback_server and self.callback_server is not None:
+            await self.callback_server.stop()
+            self.callback_server = None
+
+    def _token_headers(self):
+        # Public clients have no secret to authenticate with; they send
+        # their client_id in the body and rely on PKCE instead.
+        if not self._client_secret:
+            return {'Content-Type': FORM_CONTENT_TYPE}
+        return super()._token_headers()
+
+    async def _grant_data(self):
+        if self.callback_server is None:
+            self.callback_server = await CallbackServer(
+                self._port_range).start()
+        server = self.callback_server
+
+        verifier, challenge = make_pkce_pair()
+        state = server.expect()
+        params = {
+            'response_type': 'code',
+            'client_id': self._client_id,
+            'redirect_uri': server.redirect_uri,
+            'state': state,
+            'code_challenge': challenge,
+            'code_challenge_method': 'S256',
+        }
+        self._add_scope(params)
+        webbrowser.open('%s?%s' % (self._authorize_endpoint,
+                                   urlencode(params)))
+        callback = await server.wait(state)
+
+        return {
+            'grant_type': 'authorization_code',
+            'code': callback['code'],
+            'redirect_uri': server.redirect_uri,
+            'code_verifier': verifier,
+        }
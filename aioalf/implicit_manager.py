@@ -1,11 +1,13 @@
 import asyncio
+import inspect
+import secrets
 import webbrowser
-import random
 from urllib.parse import quote
-from asyncio import Lock
 from aiohttp import web
 from aioalf.client import Client
-from aioalf.manager import TokenManager
+from aioalf.implicit_storage import TokenStorage  # noqa
+from aioalf.manager import TokenManager, TokenError, token_lifetime
+from aioalf.token import Token
 
 
 DEFAULT_PAGE = """<!DOCTYPE html><html><head><script>window.location = window.location.href.replace('#', '?');</script></head><body></body></html>"""  # noqa
@@ -17,104 +19,158 @@ CLOSE_PAGE = """<!DOCTYPE html><html><head></head><body><script>window.close();<
 </h2></body></html>
 """
 
+CALLBACK_KEYS = ('access_token', 'code', 'error')
+
+
+async def _resolve(value):
+    # Storages written when the protocol was synchronous still work.
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class CallbackServer(object):
+
+    # Serves the redirect of every login for the life of the process; each
+    # login is told apart by the OAuth state it was started with.
+
+    def __init__(self, port_range=(32000, 32009), host='localhost'):
+        self.port_range = port_range
+        self.host = host
+        self.port = None
+        self._runner = None
+        self._waiters = {}
+
+    @property
+    def redirect_uri(self):
+        return 'http://%s:%d' % (self.host, self.port)
+
+    @property
+    def pending(self):
+        return len(self._waiters)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+
+        ports = [0] if self.port_range is None else range(
+            self.port_range[0], self.port_range[1] + 1)
+        for port in ports:
+            site = web.TCPSite(self._runner, self.host, port)
+            try:
+                await site.start()
+            except OSError:
+                continue
+            self.port = self._runner.addresses[0][1]
+            return self
+
+        await self._runner.cleanup()
+        raise TokenError('No free port for the callback server in %s-%s' %
+                         self.port_range)
+
+    async def stop(self):
+        for waiter in self._waiters.values():
+            waiter.cancel()
+        self._waiters.clear()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def expect(self):
+        state = secrets.token_urlsafe(16)
+        self._waiters[state] = asyncio.get_event_loop().create_future()
+        return state
+
+    async def wait(self, state):
+        try:
+            return await self._waiters[state]
+        finally:
+            self._waiters.pop(state, None)
 
-class TokenStorage:
-
-    def __init__(self):
-        self.token = None
-
-    def save(self, token):
-        self.token = token
-
-    def load(self):
-        return self.token
-
-    def clean(self):
-        self.token = None
-
-
-async def _run_web_server(port_range):
-    async def token_handler(request):
-        if 'access_token' not in request.query:
+    async def _handle(self, request):
+        query = request.query
+        if not any(key in query for key in CALLBACK_KEYS):
             return web.Response(body=DEFAULT_PAGE, content_type='text/html')
 
-        token = {
-            'access_token': request.query.get('access_token'),
-            'token_type': request.query.get('token_type'),
-            'expires_in': request.query.get('expires_in')
-        }
-
-        request.app['token_waiter'].set_result(token)
+        waiter = self._waiters.get(query.get('state'))
+        if waiter is None or waiter.done():
+            return web.Response(status=400, text='Unknown or expired login')
 
+        if 'error' in query:
+            waiter.set_exception(TokenError('Authorization failed: %s' %
+                                            query['error']))
+        else:
+            waiter.set_result(dict(query))
         return web.Response(body=CLOSE_PAGE, content_type='text/html')
 
-    loop = asyncio.get_event_loop()
-
-    app = web.Application()
-    app['token_waiter'] = loop.create_future()
-    app['port'] = random.randint(*port_range)
-
-    app.router.add_get('/', token_handler)
-
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, 'localhost', app['port'])
-    await site.start()
-    return app, site
-
 
 class OAuthImplictTokenManager(TokenManager):
 
-    app = None
-    site = None
-    browser_has_been_opened = False
+    callback_server = None
     storage = None
 
     def __init__(self, token_endpoint,
                  client_id, client_secret, http_options=None,
-                 scope=None):
-        self._token_endpoint = token_endpoint
-        self._client_id = client_id
-        self._client_secret = client_secret
-        self._scope = scope
-        self._http_options = http_options if http_options else {}
-        self._token_lock = Lock()
-
-    def _shall_open_browser(cls):
-        if not cls.browser_has_been_opened:
-            cls.browser_has_been_opened = True
-            return True
-        else:
-            return False
+                 scope=None, **kwargs):
+        super().__init__(token_endpoint, client_id, client_secret,
+                         http_options=http_options, scope=scope, **kwargs)
 
     async def get_token(self):
         async with self._token_lock:
+            if self._token is not None and not self._token.is_valid():
+                # The redirect said when this token expires; tokens loaded
+                # from storage are used until they are rejected.
+                self._token = None
+                await _resolve(self.storage.clean())
+
+            token = await self._get_stored_token()
+            if token:
+                return token
+
             token = await self._retrieve_token()
-            self.storage.save(token)
+            if token:
+                await _resolve(self.storage.save(token))
             return token
 
-    def reset_token(self):
-        self.storage.clean()
+    async def reset_token(self, access_token=None):
+        async with self._token_lock:
+            # A token other than the rejected one was already stored by
+            # a request that got here first.
+            stored = await self._get_stored_token()
+            if access_token is None or stored in (None, access_token):
+                self._token = None
+                await _resolve(self.storage.clean())
+            return True
 
-    def _get_stored_token(self):
-        return self.storage.load()
+    async def _get_stored_token(self):
+        return await _resolve(self.storage.load())
 
     async def _retrieve_token(self):
-        token = self._get_stored_token()
-        if token:
-            return token
-
-        token = await self._ask_for_token()
-        return token.get('access_token')
+        token_data = await self._ask_for_token()
+        access_token = token_data.get('access_token') if token_data else None
+        if not access_token:
+            return None
+
+        # The deadline of a previous login must not outlive its token.
+        self._token = None
+        claims, expires_in = token_lifetime(token_data)
+        if expires_in and float(expires_in) > 0:
+            self._token = Token(access_token, expires_in, clock=self._clock,
+                                skew=self._expiry_skew, claims=claims)
+        return access_token
 
     async def _ask_for_token(self):
+        server = self.callback_server
+        state = server.expect()
         token_url_template = (
             "{}/authorize?response_type=token&client_id={}&redirect_uri={}")
 
         token_url = token_url_template.format(
             self._token_endpoint,
             quote(self._client_id),
-            quote("http://localhost:%d" % self.app['port']),
+            quote(server.redirect_uri),
         )
 
         if self._scope:
@@ -123,23 +179,14 @@ class OAuthImplictTokenManager(TokenManager):
                 scope = " ".join(self._scope)
             token_url = "{}&scope={}".format(token_url, quote(scope))
 
-        if self._shall_open_browser():
-            webbrowser.open(token_url)
-
-        result = None
-        try:
-            result = await self.app['token_waiter']
-        except asyncio.CancelledError:
-            await self.site.stop()
-            return {'error': 'cancelled'}
-        finally:
-            await self.site.stop()
-            return result
+        token_url = "{}&state={}".format(token_url, state)
+        webbrowser.open(token_url)
+        return await server.wait(state)
 
 
 async def use_implicit_flow(token_storage, port_range=(32000, 32009)):
-    app, site = await _run_web_server(port_range)
-    OAuthImplictTokenManager.app = app
-    OAuthImplictTokenManager.site = site
+    if OAuthImplictTokenManager.callback_server is None:
+        OAuthImplictTokenManager.callback_server = await CallbackServer(
+            port_range).start()
     OAuthImplictTokenManager.storage = token_storage
     Client.token_manager_class = OAuthImplictTokenManager
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+
+try:
+    import keyring
+except ImportError:  # pragma: no cover
+    keyring = None
+
+
+class TokenStorage(object):
+
+    def __init__(self):
+        self.token = None
+
+    async def save(self, token):
+        self.token = token
+
+    async def load(self):
+        return self.token
+
+    async def clean(self):
+        self.token = None
+
+
+class _BlockingTokenStorage(TokenStorage):
+
+    async def save(self, token):
+        await self._run(self._write, token)
+
+    async def load(self):
+        return await self._run(self._read)
+
+    async def clean(self):
+        await self._run(self._remove)
+
+    @staticmethod
+    async def _run(function, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, function, *args)
+
+
+class FileTokenStorage(_BlockingTokenStorage):
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = os.path.expanduser(path)
+
+    def _read(self):
+        try:
+            with open(self.path) as token_file:
+                return token_file.read().strip() or None
+        except OSError:
+            return None
+
+    def _write(self, token):
+        # Written next to the target and renamed over it, so a crash never
+        # leaves a half written token behind.
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as token_file:
+                token_file.write(token)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class KeyringTokenStorage(_BlockingTokenStorage):
+
+    def __init__(self, username, service='aioalf', backend=None):
+        if backend is None and keyring is None:
+            raise RuntimeError('KeyringTokenStorage requires the keyring '
+                               'package, or a backend')
+        super().__init__()
+        self.username = username
+        self.service = service
+        self._backend = backend or keyring
+
+    def _read(self):
+        return self._backend.get_password(self.service, self.username)
+
+    def _write(self, token):
+        self._backend.set_password(self.service, self.username, token)
+
+    def _remove(self):
+        # keyring raises PasswordDeleteError for a missing password.
+        if self._read() is not None:
+            self._backend.delete_password(self.service, self.username)
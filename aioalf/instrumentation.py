@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import math
+
+
+class Signal(list):
+
+    def send(self, **kwargs):
+        for callback in self:
+            callback(**kwargs)
+
+
+class Instrumentation(object):
+
+    SIGNALS = (
+        'on_token_cache_hit',
+        'on_token_cache_miss',
+        'on_token_lock_wait',
+        'on_token_fetch',
+        'on_stale_token',
+        'on_bad_token_retry',
+        'on_request_end',
+        'on_rate_limit_wait',
+        'on_rate_limited',
+        'on_response_cache',
+    )
+
+    def __init__(self):
+        for name in self.SIGNALS:
+            setattr(self, name, Signal())
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.values = []
+
+    def observe(self, value):
+        self.values.append(value)
+
+    @property
+    def count(self):
+        return len(self.values)
+
+    @property
+    def total(self):
+        return sum(self.values)
+
+    def percentile(self, percent):
+        if not self.values:
+            return None
+        values = sorted(self.values)
+        rank = max(0, math.ceil(percent / 100.0 * len(values)) - 1)
+        return values[rank]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': max(self.values) if self.values else None,
+        }
+
+
+class MetricsCollector(object):
+
+    def __init__(self, instrumentation=None):
+        self.counters = {}
+        self.histograms = {}
+        if instrumentation is not None:
+            self.attach(instrumentation)
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def attach(self, instrumentation):
+        instrumentation.on_token_cache_hit.append(self._on_token_cache_hit)
+        instrumentation.on_token_cache_miss.append(self._on_token_cache_miss)
+        instrumentation.on_token_lock_wait.append(self._on_token_lock_wait)
+        instrumentation.on_token_fetch.append(self._on_token_fetch)
+        instrumentation.on_stale_token.append(self._on_stale_token)
+        instrumentation.on_bad_token_retry.append(self._on_bad_token_retry)
+        instrumentation.on_request_end.append(self._on_request_end)
+        instrumentation.on_rate_limit_wait.append(self._on_rate_limit_wait)
+        instrumentation.on_rate_limited.append(self._on_rate_limited)
+        instrumentation.on_response_cache.append(self._on_response_cache)
+        return self
+
+    def snapshot(self):
+        return {
+            'counters': dict(self.counters),
+            'histograms': {name: histogram.summary()
+                           for name, histogram in self.histograms.items()},
+        }
+
+    def _on_token_cache_hit(self):
+        self.increment('token_cache_hits')
+
+    def _on_token_cache_miss(self):
+        self.increment('token_cache_misses')
+
+    def _on_token_lock_wait(self, duration):
+        self.observe('token_lock_wait', duration)
+
+    def _on_token_fetch(self, duration, status, error=None):
+        self.increment('token_fetches')
+        if error is not None:
+            self.increment('token_fetch_errors')
+        self.increment('token_fetch_status.%s' % status)
+        self.observe('token_fetch_duration', duration)
+
+    def _on_stale_token(self):
+        self.increment('stale_tokens_served')
+
+    def _on_bad_token_retry(self, method, url):
+        self.increment('bad_token_retries')
+
+    def _on_request_end(self, method, url, status, duration, error=None):
+        self.increment('requests')
+        if error is not None:
+            self.increment('request_errors')
+        self.observe('request_duration', duration)
+
+    def _on_rate_limit_wait(self, key, duration):
+        self.observe('rate_limit_wait', duration)
+
+    def _on_rate_limited(self, key, delay):
+        self.increment('rate_limited')
+
+    def _on_response_cache(self, method, url, outcome):
+        self.increment('response_cache.%s' % outcome)
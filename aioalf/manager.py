@@ -1,19 +1,75 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import random
+import time
 from base64 import b64encode
-from aioalf.token import Token, TokenError, TokenHTTPError, TOKEN_FILTER
-from aiohttp import ClientSession, ClientResponseError
+from functools import partial
+from urllib.parse import urlencode
+from aioalf.token import (Token, TokenError, TokenHTTPError, log_request,
+                          decode_jwt_claims, jwt_expires_in)
+from aiohttp import ClientSession, ClientResponseError, ClientError, TCPConnector
 from asyncio import Lock
 
 import logging
 
+try:
+    from orjson import loads as json_loads
+except ImportError:  # pragma: no cover
+    from json import loads as json_loads
+
 logger = logging.getLogger(__name__)
 
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+
+FETCH_ERRORS = (TokenError, ClientError, asyncio.TimeoutError)
+
+
+def scope_key(scope):
+    if scope is None:
+        return None
+    if isinstance(scope, str):
+        scope = scope.split()
+    return tuple(sorted(set(scope)))
+
+
+def secret_digest(client_secret):
+    # Keys built from the credentials tell secrets apart without keeping
+    # the secret itself.
+    return hashlib.sha256((client_secret or '').encode('utf-8')).hexdigest()
+
+
+def basic_auth_header(client_id, client_secret):
+    try:
+        passhash = b64encode(':'.join((client_id, client_secret))
+                             .encode('ascii'))
+    except (TypeError, UnicodeEncodeError):
+        return None
+    return 'Basic %s' % passhash.decode('ascii')
+
+
+def token_lifetime(token_data):
+    # A JWT carries its own expiry, which is trusted over expires_in,
+    # unless it is already past: the token may be expired, or our clock
+    # ahead of the server's, and trusting it would refetch on every call.
+    claims = decode_jwt_claims(token_data.get('access_token', ''))
+    expires_in = jwt_expires_in(claims)
+    if expires_in is None or expires_in <= 0:
+        expires_in = token_data.get('expires_in', 0)
+    return claims, expires_in
+
 
 class TokenManager(object):
 
     def __init__(self, token_endpoint, client_id,
                  client_secret, http_options=None,
-                 scope=None):
+                 scope=None, refresh_ratio=None, refresh_jitter=0.1,
+                 session=None, connector_options=None, store=None,
+                 expiry_skew=0, clock=time.monotonic, retry_policy=None,
+                 circuit_breaker=None, stale_grace=None,
+                 stale_retry_interval=1.0, instrumentation=None,
+                 min_reset_interval=None, refresh_token=None,
+                 json_loads=json_loads):
 
         self._token_endpoint = token_endpoint
         self._client_id = client_id
@@ -22,35 +78,310 @@ class TokenManager(object):
         self._token = None
         self._http_options = http_options if http_options else {}
         self._token_lock = Lock()
+        self._refresh_ratio = refresh_ratio
+        self._refresh_jitter = refresh_jitter
+        self._refresh_task = None
+        self._session = session
+        self._owns_session = session is None
+        self._connector_options = connector_options
+        self._store = store
+        self._expiry_skew = expiry_skew
+        self._clock = clock
+        self._retry_policy = retry_policy
+        self._circuit_breaker = circuit_breaker
+        self._stale_grace = stale_grace
+        self._stale_retry_interval = stale_retry_interval
+        self._stale_task = None
+        self.stale_tokens_served = 0
+        self._instrumentation = instrumentation
+        self._min_reset_interval = min_reset_interval
+        self._updated_at = None
+        self._fetch_generation = 0
+        self._token_generation = 0
+        self._fetch_error = None
+        self._refresh_token = refresh_token
+        self._json_loads = json_loads
+        # Token requests only differ by their grant, so the headers and the
+        # client credentials body are encoded once.
+        basic_auth = basic_auth_header(client_id, client_secret)
+        self._basic_headers = basic_auth and {
+            'Authorization': basic_auth,
+            'Content-Type': FORM_CONTENT_TYPE,
+        }
+        self._grant_body = None
+
+    async def close(self):
+        self._cancel_refresh()
+        if self._stale_task is not None:
+            self._stale_task.cancel()
+            self._stale_task = None
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        # Token requests go through one long-lived session so the
+        # connection to the token endpoint is kept alive between refreshes.
+        if self._session is None:
+            connector = None
+            if self._connector_options:
+                connector = TCPConnector(**self._connector_options)
+            self._session = ClientSession(connector=connector)
+        return self._session
+
+    def for_scope(self, scope):
+        if scope_key(scope) != scope_key(self._scope):
+            raise ValueError('%s only handles scope %r, use a '
+                             'MultiScopeTokenManager for scope %r' % (
+                                 type(self).__name__, self._scope, scope))
+        return self
 
     def _has_token(self):
         return self._token and self._token.is_valid()
 
     async def get_token(self):
-        async with self._token_lock:
-            if not self._has_token():
-                await self._update_token()
+        # The lock is only needed to single-flight a refresh; a valid
+        # cached token can be handed out without queueing on it.
+        instrumentation = self._instrumentation
+        if self._has_token():
+            if instrumentation is not None:
+                instrumentation.on_token_cache_hit.send()
             return self._token.access_token
+        if self._stale_task is not None and self._can_serve_stale():
+            return self._serve_stale()
+
+        if instrumentation is not None:
+            instrumentation.on_token_cache_miss.send()
+        waiting_since = time.perf_counter()
+        generation = self._fetch_generation
+        async with self._token_lock:
+            if instrumentation is not None:
+                instrumentation.on_token_lock_wait.send(
+                    duration=time.perf_counter() - waiting_since)
+            if self._has_token():
+                return self._token.access_token
+            if self._failed_since(generation):
+                if not self._can_serve_stale():
+                    raise self._fetch_error
+                return self._serve_stale()
+
+            if self._stale_task is None or not self._can_serve_stale():
+                try:
+                    await self._update_token()
+                    return self._token.access_token
+                except FETCH_ERRORS as e:
+                    if not self._can_serve_stale():
+                        raise
+                    logger.warning('Token refresh failed (%s), serving the '
+                                   'expired token while retrying', e)
+                    self._stale_task = asyncio.ensure_future(
+                        self._refresh_stale())
+
+            return self._serve_stale()
+
+    def _failed_since(self, generation):
+        # Callers queued behind a fetch that failed get its error rather
+        # than starting another fetch, with its retries, one after another.
+        if self._fetch_generation == generation:
+            return False
+        return self._fetch_error is not None
+
+    def _can_serve_stale(self):
+        if self._stale_grace is None or self._token is None:
+            return False
+        return self._token.is_valid(grace=self._stale_grace)
+
+    def _serve_stale(self):
+        self.stale_tokens_served += 1
+        if self._instrumentation is not None:
+            self._instrumentation.on_stale_token.send()
+        return self._token.access_token
+
+    async def _refresh_stale(self):
+        try:
+            while self._can_serve_stale():
+                await asyncio.sleep(self._stale_retry_interval)
+                async with self._token_lock:
+                    if self._has_token():
+                        return
+                    try:
+                        await self._update_token()
+                        return
+                    except FETCH_ERRORS as e:
+                        logger.warning('Token refresh failed: %s', e)
+        finally:
+            self._stale_task = None
+
+    def _store_key(self):
+        scope = self._scope
+        if isinstance(scope, list):
+            scope = " ".join(self._scope)
+        # A worker with a wrong or rotated secret must not read the token
+        # fetched with another one.
+        return '%s %s %s %s' % (self._token_endpoint, self._client_id,
+                                secret_digest(self._client_secret), scope)
 
     async def _get_token_data(self):
-        return await self._request_token()
+        if self._store is None:
+            return await self._request_token()
+
+        # Other processes sharing the store may already have replaced the
+        # token we hold, so only go to the endpoint if they have not.
+        key = self._store_key()
+        current = self._token.access_token if self._token else None
+        async with self._store.lock(key):
+            token_data = await self._store.load(key)
+            fresh = False
+            if token_data is not None:
+                fresh = token_lifetime(token_data)[1] > 0
+            if fresh and token_data.get('access_token') != current:
+                return token_data
 
-    async def reset_token(self):
-        await self._update_token()
+            token_data = await self._request_token()
+            await self._store.save(key, token_data)
+            return token_data
+
+    async def reset_token(self, access_token=None):
+        # Every request rejected with the same token asks for a reset; only
+        # the first one refreshes, the rest wait here and reuse its result.
+        # Servers may issue the same token again, so a refresh is told by
+        # its generation rather than by the token.
+        generation = self._fetch_generation
+        async with self._token_lock:
+            if self._was_replaced(access_token):
+                return True
+            if self._token_generation > generation:
+                return True
+            if self._failed_since(generation):
+                raise self._fetch_error
+            if access_token is not None and self._resets_limited():
+                logger.warning('Token was rejected again less than %ss after '
+                               'it was fetched, not refreshing it',
+                               self._min_reset_interval)
+                return False
+
+            await self._update_token()
+            return self._token_generation > generation
+
+    def _resets_limited(self):
+        # A token rejected right after it was issued is most likely fine,
+        # refreshing it again would only hammer the token endpoint.
+        if self._min_reset_interval is None or self._updated_at is None:
+            return False
+        return self._clock() - self._updated_at < self._min_reset_interval
+
+    def _was_replaced(self, access_token):
+        if access_token is None or self._token is None:
+            return False
+        return self._token.access_token != access_token
 
     async def _update_token(self):
-        token_data = await self._get_token_data()
-        self._token = Token(token_data.get('access_token', ''),
-                            token_data.get('expires_in', 0))
+        breaker = self._circuit_breaker
+        if breaker is not None and not breaker.allow():
+            if self._has_token():
+                logger.warning('Token endpoint circuit is open, '
+                               'keeping the current token')
+                return
+            raise TokenError('Token endpoint circuit is open')
+
+        started = time.perf_counter()
+        try:
+            token_data = await self._get_token_data()
+        except FETCH_ERRORS as e:
+            self._fetch_finished(started, e)
+            self._fetch_generation += 1
+            self._fetch_error = e
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+
+        self._fetch_finished(started)
+        self._fetch_generation += 1
+        self._token_generation = self._fetch_generation
+        self._fetch_error = None
+        self._updated_at = self._clock()
+        if breaker is not None:
+            breaker.record_success()
+        # Servers that do not rotate refresh tokens leave it out on refresh.
+        self._refresh_token = token_data.get('refresh_token',
+                                             self._refresh_token)
+        claims, expires_in = token_lifetime(token_data)
+        self._token = Token(token_data.get('access_token', ''), expires_in,
+                            clock=self._clock, skew=self._expiry_skew,
+                            claims=claims)
+        self._schedule_refresh(int(expires_in))
+
+    def _fetch_finished(self, started, error=None):
+        if self._instrumentation is None:
+            return
+        if error is None:
+            status = 200
+        else:
+            status = getattr(error, 'response_status', None)
+        self._instrumentation.on_token_fetch.send(
+            duration=time.perf_counter() - started, status=status,
+            error=error)
+
+    def _schedule_refresh(self, expires_in):
+        if self._refresh_ratio is None or expires_in <= 0:
+            return
+
+        self._cancel_refresh()
+        jitter = random.uniform(-self._refresh_jitter, self._refresh_jitter)
+        delay = expires_in * self._refresh_ratio * (1 + jitter)
+        self._refresh_task = asyncio.ensure_future(self._refresh_later(delay))
+
+    def _cancel_refresh(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    async def _refresh_later(self, delay):
+        await asyncio.sleep(delay)
+        # Detach first so the reschedule done by _update_token does not
+        # cancel the task that is running it.
+        self._refresh_task = None
+        async with self._token_lock:
+            try:
+                await self._update_token()
+            except FETCH_ERRORS as e:
+                logger.warning('Background token refresh failed: %s', e)
 
     async def _request_token(self):
         if not self._token_endpoint:
             raise TokenError('Missing token endpoint')
 
+        # Renewing with a refresh token is one POST; only when it is
+        # rejected do we go through the full grant again.
+        if self._refresh_token:
+            try:
+                return await self._post_token(self._refresh_data())
+            except TokenHTTPError as e:
+                if e.response_status not in (400, 401):
+                    raise
+                logger.info('Refresh token rejected, requesting a new grant')
+                self._refresh_token = None
+
+        return await self._post_token(await self._grant_data())
+
+    async def _grant_data(self):
+        if self._grant_body is None:
+            data = {
+                'grant_type': 'client_credentials',
+            }
+            self._add_scope(data)
+            self._grant_body = urlencode(data).encode('ascii')
+        return self._grant_body
+
+    def _refresh_data(self):
         data = {
-            'grant_type': 'client_credentials',
+            'grant_type': 'refresh_token',
+            'refresh_token': self._refresh_token,
         }
+        self._add_scope(data)
+        return data
 
+    def _add_scope(self, data):
         if self._scope:
             scope = self._scope
             if isinstance(scope, list):
@@ -58,49 +389,52 @@ class TokenManager(object):
 
             data['scope'] = scope
 
-        return await self._fetch(
+    def _token_headers(self):
+        if self._basic_headers is None:
+            raise TokenError('Missing credentials (client_id:client_secret)')
+        return self._basic_headers
+
+    async def _post_token(self, data):
+        headers = self._token_headers()
+        if not isinstance(data, bytes):
+            if 'Authorization' not in headers:
+                data = dict(data, client_id=self._client_id)
+            data = urlencode(data).encode('ascii')
+
+        fetch = partial(
+            self._fetch,
             url=self._token_endpoint,
             method="POST",
-            auth=(self._client_id, self._client_secret),
+            headers=headers,
             data=data
         )
 
-    async def _fetch(self, url, method="GET", data=None, auth=None):
+        if self._retry_policy is None:
+            return await fetch()
+        return await self._retry_policy.call(fetch)
+
+    async def _fetch(self, url, method="GET", data=None, headers=None):
         request_data = dict(
-            headers={},
+            headers=headers or {},
             data=data
         )
-
-        if auth is not None:
-            try:
-                passhash = b64encode(':'.join(auth).encode('ascii'))
-            except TypeError as e:
-                raise TokenError(
-                    'Missing credentials (client_id:client_secret)', str(e)
-                )
-
-            request_data['headers']['Authorization'] = (
-                'Basic %s' % passhash.decode('utf-8')
-            )
-
         request_data.update(self._http_options)
 
-        logger.debug('Request: %s %s', method, url)
-        for header in request_data.get('headers'):
-            if header.lower() == 'authorization':
-                authorization_data = request_data.get('headers', {}).get(header)
-                matches = TOKEN_FILTER.match(authorization_data)
-                if matches:
-                    logger.debug(('Header {}: {}<...>{}').format(header,
-                                                                 matches.group('start'),
-                                                                 matches.group('end')))
-                continue
-            logger.debug('Header %s: %s', header, request_data.get('headers', {}).get(header))
+        log_request(logger, method, url, request_data['headers'])
 
         try:
-            async with ClientSession() as client:
-                response = await client.request(method, url, **request_data)
-                result = await response.json()
-                return result
+            session = self._get_session()
+            response = await session.request(method, url, **request_data)
+            body = await response.read()
+            if response.status >= 400:
+                raise TokenHTTPError('Failed to request token',
+                                     response.status,
+                                     body.decode('utf-8', 'replace'))
+            try:
+                return self._json_loads(body)
+            except ValueError:
+                raise TokenHTTPError('Invalid token response',
+                                     response.status,
+                                     body.decode('utf-8', 'replace'))
         except ClientResponseError as e:
             raise TokenHTTPError('Failed to request token', e.status, e.message)
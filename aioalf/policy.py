@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import random
+import time
+
+from aiohttp import ClientError
+from aioalf.token import TokenError, TokenHTTPError
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RetryPolicy(object):
+
+    def __init__(self, timeout=None, retries=0, backoff=0.1,
+                 max_backoff=5.0, jitter=0.1, retry_statuses=RETRY_STATUSES):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+
+    def delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def is_retryable(self, error):
+        if isinstance(error, TokenHTTPError):
+            return error.response_status in self.retry_statuses
+        return isinstance(error, (ClientError, asyncio.TimeoutError))
+
+    async def call(self, function):
+        if self.timeout is None:
+            return await self._attempts(function)
+
+        try:
+            return await asyncio.wait_for(self._attempts(function),
+                                          self.timeout)
+        except asyncio.TimeoutError:
+            raise TokenError(
+                'Token request timed out after %ss' % self.timeout)
+
+    async def _attempts(self, function):
+        attempt = 0
+        while True:
+            try:
+                return await function()
+            except Exception as e:
+                if attempt >= self.retries or not self.is_retryable(e):
+                    if isinstance(e, ClientError):
+                        raise TokenError('Failed to request token: %s' % e)
+                    raise
+
+                delay = self.delay(attempt)
+                logger.warning('Token request failed (%s), retrying in %.2fs',
+                               e, delay)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+
+class CircuitBreaker(object):
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        return self.state != self.OPEN
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+
+    def record_failure(self):
+        self._failures += 1
+        half_open = self.state == self.HALF_OPEN
+        if half_open or self._failures >= self.failure_threshold:
+            self._opened_at = self._clock()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+RETRY_AFTER_STATUSES = (429, 503)
+
+
+def by_host(method, url):
+    return urlsplit(str(url)).netloc
+
+
+def retry_after(response, now=None):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = time.time() if now is None else now
+    return max(0.0, date.timestamp() - now)
+
+
+class Limit(object):
+
+    # A token bucket that hands out reservations: each caller takes a token
+    # right away, possibly going negative, and sleeps until its turn in its
+    # own task. Waiters are served in order without a scheduler task.
+
+    def __init__(self, key, rate=None, burst=None, concurrency=None,
+                 clock=time.monotonic, instrumentation=None):
+        self.key = key
+        self.rate = rate
+        self.burst = burst or max(1, rate or 1)
+        self.waiting = 0
+        self.in_flight = 0
+        self._clock = clock
+        self._instrumentation = instrumentation
+        self._tokens = self.burst
+        self._updated_at = clock()
+        self._blocked_until = 0
+        self._semaphore = concurrency and asyncio.Semaphore(concurrency)
+
+    @property
+    def blocked_for(self):
+        return max(0, self._blocked_until - self._clock())
+
+    async def acquire(self):
+        started = self._clock()
+        delay = self._reserve(started)
+        if not delay and self._semaphore is None:
+            self.in_flight += 1
+            return
+
+        self.waiting += 1
+        acquired = False
+        try:
+            while delay > 0:
+                await asyncio.sleep(delay)
+                # A Retry-After may have come in while we slept.
+                delay = self.blocked_for
+            if self._semaphore is not None:
+                await self._semaphore.acquire()
+            acquired = True
+        finally:
+            self.waiting -= 1
+            if not acquired and self.rate is not None:
+                self._tokens += 1
+
+        self.in_flight += 1
+        waited = self._clock() - started
+        if waited > 0 and self._instrumentation is not None:
+            self._instrumentation.on_rate_limit_wait.send(key=self.key,
+                                                          duration=waited)
+
+    def release(self):
+        self.in_flight -= 1
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def block(self, delay):
+        now = self._clock()
+        until = now + delay
+        if until <= self._blocked_until:
+            return
+        self._blocked_until = until
+        if self.rate is not None:
+            # The bucket refills from the end of the pause, so the requests
+            # queued behind it are spread out instead of sent at once.
+            self._refill(now)
+            self._tokens = min(self._tokens, 0)
+            self._updated_at = until
+        if self._instrumentation is not None:
+            self._instrumentation.on_rate_limited.send(key=self.key,
+                                                       delay=delay)
+
+    def _refill(self, now):
+        if now > self._updated_at:
+            elapsed = now - self._updated_at
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+            self._updated_at = now
+
+    def _reserve(self, now):
+        delay = self._blocked_until - now
+        if self.rate is not None:
+            self._refill(now)
+            self._tokens -= 1
+            if self._tokens < 0:
+                wait = -self._tokens / self.rate
+                delay = max(delay, self._updated_at - now + wait)
+        return max(0, delay)
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate=None, burst=None, concurrency=None, key=by_host,
+                 max_retry_after=300, clock=time.monotonic,
+                 instrumentation=None):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.max_retry_after = max_retry_after
+        self._key = key
+        self._clock = clock
+        self._instrumentation = instrumentation
+        self._limits = {}
+
+    @property
+    def queue_depth(self):
+        return sum(limit.waiting for limit in self._limits.values())
+
+    def limit(self, method, url):
+        key = self._key(method, url)
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = self._limits[key] = Limit(
+                key, rate=self.rate, burst=self.burst,
+                concurrency=self.concurrency, clock=self._clock,
+                instrumentation=self._instrumentation)
+        return limit
+
+    def observe(self, limit, response):
+        if response.status not in RETRY_AFTER_STATUSES:
+            return
+        delay = retry_after(response)
+        if delay:
+            if self.max_retry_after is not None:
+                delay = min(delay, self.max_retry_after)
+            limit.block(delay)
+
+    def stats(self):
+        return {
+            key: {
+                'waiting': limit.waiting,
+                'in_flight': limit.in_flight,
+                'blocked_for': limit.blocked_for,
+            }
+            for key, limit in self._limits.items()
+        }
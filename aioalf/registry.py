@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from aioalf.manager import scope_key, secret_digest
+
+logger = logging.getLogger(__name__)
+
+
+class _RegistryEntry(object):
+
+    def __init__(self, key, manager, options):
+        self.key = key
+        self.manager = manager
+        self.options = options
+        self.references = 0
+
+
+class TokenManagerRegistry(object):
+
+    def __init__(self):
+        self._entries = {}
+        self._by_manager = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(manager_class, token_endpoint, client_id, client_secret,
+                 scope=None):
+        # A client with the wrong secret must not get a manager built with
+        # the right one.
+        return (manager_class, token_endpoint, client_id,
+                secret_digest(client_secret), scope_key(scope))
+
+    def acquire(self, manager_class, token_endpoint, client_id,
+                client_secret, http_options=None, scope=None, **kwargs):
+        key = self.make_key(manager_class, token_endpoint, client_id,
+                            client_secret, scope)
+        options = dict(kwargs, http_options=http_options or {})
+        entry = self._entries.get(key)
+        if entry is None:
+            logger.debug('Creating shared token manager for %s at %s',
+                         client_id, token_endpoint)
+            manager = manager_class(token_endpoint=token_endpoint,
+                                    client_id=client_id,
+                                    client_secret=client_secret,
+                                    http_options=http_options,
+                                    scope=scope,
+                                    **kwargs)
+            entry = _RegistryEntry(key, manager, options)
+            self._entries[key] = entry
+            self._by_manager[id(manager)] = entry
+        elif options != entry.options:
+            # The manager is already built, so only its first client's
+            # options apply.
+            logger.warning('Shared token manager for %s at %s was created '
+                           'with other options (%s), ignoring these',
+                           client_id, token_endpoint,
+                           ', '.join(sorted(self._differences(entry.options,
+                                                              options))))
+
+        entry.references += 1
+        return entry.manager
+
+    @staticmethod
+    def _differences(current, options):
+        return set(name for name in set(current) | set(options)
+                   if current.get(name) != options.get(name))
+
+    async def release(self, manager):
+        entry = self._by_manager.get(id(manager))
+        if entry is None or entry.manager is not manager:
+            return
+
+        entry.references -= 1
+        if entry.references > 0:
+            return
+
+        del self._entries[entry.key]
+        del self._by_manager[id(manager)]
+        await manager.close()
+
+
+default_registry = TokenManagerRegistry()
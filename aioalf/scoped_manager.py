@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+from collections import OrderedDict
+
+from aiohttp import ClientSession, TCPConnector
+from aioalf.manager import TokenManager, scope_key
+
+logger = logging.getLogger(__name__)
+
+
+class MultiScopeTokenManager(object):
+
+    token_manager_class = TokenManager
+
+    def __init__(self, token_endpoint, client_id, client_secret,
+                 http_options=None, scope=None, max_scopes=32, session=None,
+                 connector_options=None, **manager_options):
+        self._token_endpoint = token_endpoint
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._http_options = http_options
+        self._scope = scope
+        self._max_scopes = max_scopes
+        self._session = session
+        self._owns_session = session is None
+        self._connector_options = connector_options
+        self._manager_options = manager_options
+        self._managers = OrderedDict()
+
+    async def close(self):
+        managers = list(self._managers.values())
+        self._managers.clear()
+        for manager in managers:
+            await manager.close()
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            connector = None
+            if self._connector_options:
+                connector = TCPConnector(**self._connector_options)
+            self._session = ClientSession(connector=connector)
+        return self._session
+
+    def for_scope(self, scope):
+        # Each scope gets its own manager, and so its own token and lock;
+        # they all borrow this manager's session.
+        key = scope_key(scope)
+        manager = self._managers.get(key)
+        if manager is not None:
+            self._managers.move_to_end(key)
+            return manager
+
+        manager = self.token_manager_class(
+            token_endpoint=self._token_endpoint,
+            client_id=self._client_id,
+            client_secret=self._client_secret,
+            http_options=self._http_options,
+            scope=' '.join(key) if key else None,
+            session=self._get_session(),
+            **self._manager_options)
+        self._managers[key] = manager
+        while len(self._managers) > self._max_scopes:
+            evicted_key, evicted = self._managers.popitem(last=False)
+            logger.debug('Evicting token manager for scope %s', evicted_key)
+            asyncio.ensure_future(evicted.close())
+        return manager
+
+    @property
+    def scopes(self):
+        return list(self._managers)
+
+    async def get_token(self):
+        return await self.for_scope(self._scope).get_token()
+
+    async def reset_token(self, access_token=None):
+        return await self.for_scope(self._scope).reset_token(access_token)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import json
+import os
+import secrets
+import stat
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+class BaseTokenStore(object):
+
+    async def load(self, key):
+        raise NotImplementedError
+
+    async def save(self, key, token_data):
+        raise NotImplementedError
+
+    def lock(self, key):
+        raise NotImplementedError
+
+
+def private_directory(path):
+    # A directory another local user created or can write to would let
+    # them plant entries, so it is refused rather than reused.
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if not hasattr(os, 'getuid'):  # pragma: no cover
+        return path
+    info = os.lstat(path)
+    private = info.st_uid == os.getuid() and not info.st_mode & 0o022
+    if not stat.S_ISDIR(info.st_mode) or not private:
+        raise RuntimeError('%s must be a directory owned by the current '
+                           'user and not writable by others' % path)
+    return path
+
+
+def user_temp_directory(name):
+    suffix = '-%d' % os.getuid() if hasattr(os, 'getuid') else ''
+    return os.path.join(tempfile.gettempdir(), name + suffix)
+
+
+def _dump_token(token_data):
+    stored = dict(token_data)
+    stored['expires_at'] = time.time() + int(token_data.get('expires_in', 0))
+    stored.pop('expires_in', None)
+    return json.dumps(stored)
+
+
+def _load_token(value):
+    if not value:
+        return None
+
+    token_data = json.loads(value)
+    token_data['expires_in'] = token_data.pop('expires_at', 0) - time.time()
+    return token_data
+
+
+class _FileLock(object):
+
+    def __init__(self, path):
+        self._path = path
+        self._fd = None
+
+    async def __aenter__(self):
+        loop = asyncio.get_event_loop()
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            await loop.run_in_executor(None, fcntl.flock, fd, fcntl.LOCK_EX)
+        except BaseException:
+            # Closing the descriptor drops the lock if the executor got it
+            # after we were cancelled.
+            os.close(fd)
+            raise
+        self._fd = fd
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+
+class FileTokenStore(BaseTokenStore):
+
+    def __init__(self, directory=None):
+        if fcntl is None:  # pragma: no cover
+            raise RuntimeError('FileTokenStore requires fcntl (POSIX only)')
+
+        self._directory = private_directory(
+            directory or user_temp_directory('aioalf-tokens'))
+
+    def _path(self, key, suffix):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, name + suffix)
+
+    async def load(self, key):
+        try:
+            with open(self._path(key, '.json')) as token_file:
+                return _load_token(token_file.read())
+        except (OSError, ValueError):
+            return None
+
+    async def save(self, key, token_data):
+        path = self._path(key, '.json')
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory)
+        with os.fdopen(fd, 'w') as token_file:
+            token_file.write(_dump_token(token_data))
+        os.replace(tmp_path, path)
+
+    def lock(self, key):
+        return _FileLock(self._path(key, '.lock'))
+
+
+class KeyValueBackend(object):
+
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    async def add(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+    async def delete_if(self, key, value):
+        # Backends that can should do this atomically, e.g. with a Lua
+        # script on Redis; this fallback leaves a small window between the
+        # two calls.
+        if await self.get(key) == value:
+            await self.delete(key)
+
+
+class MemoryKeyValueBackend(KeyValueBackend):
+
+    def __init__(self):
+        self._data = {}
+
+    def _alive(self, key):
+        value, expires_at = self._data.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def _expiry(self, ttl):
+        return None if ttl is None else time.monotonic() + ttl
+
+    async def get(self, key):
+        return self._alive(key)
+
+    async def set(self, key, value, ttl=None):
+        self._data[key] = (value, self._expiry(ttl))
+
+    async def add(self, key, value, ttl=None):
+        if self._alive(key) is not None:
+            return False
+        self._data[key] = (value, self._expiry(ttl))
+        return True
+
+    async def delete(self, key):
+        self._data.pop(key, None)
+
+    async def delete_if(self, key, value):
+        if self._alive(key) == value:
+            del self._data[key]
+
+
+class _KeyValueLock(object):
+
+    def __init__(self, backend, key, ttl, poll_interval):
+        self._backend = backend
+        self._key = key
+        self._ttl = ttl
+        self._poll_interval = poll_interval
+        self._owner = None
+
+    async def __aenter__(self):
+        owner = secrets.token_hex(16)
+        while not await self._backend.add(self._key, owner, self._ttl):
+            await asyncio.sleep(self._poll_interval)
+        self._owner = owner
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        # After lock_ttl the lock may belong to another worker by now.
+        owner, self._owner = self._owner, None
+        await self._backend.delete_if(self._key, owner)
+
+
+class KeyValueTokenStore(BaseTokenStore):
+
+    def __init__(self, backend, namespace='aioalf', lock_ttl=30,
+                 lock_poll_interval=0.05):
+        self._backend = backend
+        self._namespace = namespace
+        self._lock_ttl = lock_ttl
+        self._lock_poll_interval = lock_poll_interval
+
+    def _key(self, key, suffix):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return '%s:%s:%s' % (self._namespace, digest, suffix)
+
+    async def load(self, key):
+        return _load_token(await self._backend.get(self._key(key, 'token')))
+
+    async def save(self, key, token_data):
+        value = _dump_token(token_data)
+        ttl = int(token_data.get('expires_in', 0)) or None
+        await self._backend.set(self._key(key, 'token'), value, ttl)
+
+    def lock(self, key):
+        return _KeyValueLock(self._backend, self._key(key, 'lock'),
+                             self._lock_ttl, self._lock_poll_interval)
@@ -1,10 +1,60 @@
 #
 # encoding: utf-8
+import json
+import logging
 import re
+import time
+from base64 import urlsafe_b64decode
 from datetime import datetime, timedelta
 
 TOKEN_FILTER = re.compile(r'^(?P<start>.*\ .{5}).*(?P<end>.{2})$')
 
+_UNDECODED = object()
+
+# The skew never takes more than this part of a token's lifetime, so a
+# skew larger than expires_in can not make tokens expire as they arrive.
+MAX_SKEW_RATIO = 0.5
+
+
+def mask_authorization(value):
+    scheme_end = value.find(' ')
+    if scheme_end < 0 or len(value) - scheme_end < 8:
+        return value[:scheme_end + 1] + '<...>'
+    return value[:scheme_end + 6] + '<...>' + value[-2:]
+
+
+def log_request(logger, method, url, headers):
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
+    logger.debug('Request: %s %s', method, url)
+    for header, value in headers.items():
+        if header.lower() == 'authorization':
+            value = mask_authorization(value)
+        logger.debug('Header %s: %s', header, value)
+
+
+def decode_jwt_claims(access_token):
+    # Only the payload is read; the signature is the resource server's
+    # business, all we want is the expiry.
+    parts = access_token.split('.')
+    if len(parts) != 3:
+        return None
+
+    payload = parts[1] + '=' * (-len(parts[1]) % 4)
+    try:
+        claims = json.loads(urlsafe_b64decode(payload).decode('utf-8'))
+    except ValueError:
+        return None
+    return claims if isinstance(claims, dict) else None
+
+
+def jwt_expires_in(claims, now=None):
+    exp = claims.get('exp') if claims else None
+    if isinstance(exp, bool) or not isinstance(exp, (int, float)):
+        return None
+    return exp - (time.time() if now is None else now)
+
 
 class TokenError(Exception):
 
@@ -31,12 +81,32 @@ class TokenHTTPError(TokenError):
 
 class Token(object):
 
-    def __init__(self, access_token='', expires_in=0):
+    __slots__ = ('access_token', '_expires_in', '_deadline', '_clock',
+                 '_claims')
+
+    def __init__(self, access_token='', expires_in=0, clock=time.monotonic,
+                 skew=0, claims=_UNDECODED):
         self.access_token = access_token
         self._expires_in = expires_in
+        self._clock = clock
+        expires_in = float(expires_in)
+        skew = min(skew, max(0, expires_in) * MAX_SKEW_RATIO)
+        self._deadline = clock() + expires_in - skew
+        self._claims = claims
+
+    @property
+    def claims(self):
+        if self._claims is _UNDECODED:
+            self._claims = decode_jwt_claims(self.access_token)
+        return self._claims
+
+    def is_valid(self, grace=0):
+        return self._clock() < self._deadline + grace
 
-        self.expires_on = datetime.utcnow() + timedelta(
-            seconds=int(self._expires_in))
+    @property
+    def expires_in(self):
+        return self._deadline - self._clock()
 
-    def is_valid(self):
-        return self.expires_on > datetime.utcnow()
+    @property
+    def expires_on(self):
+        return datetime.utcnow() + timedelta(seconds=self.expires_in)
@@ -0,0 +1,46 @@
+#
+# encoding: utf-8
+"""
+Runs the load scenarios against a local stub auth and resource server.
+
+    python -m benchmarks [scenario ...] [--requests N] [--concurrency N]
+"""
+import argparse
+import asyncio
+
+from benchmarks.scenarios import SCENARIOS, run
+
+HEADER = '%-20s %8s %9s %9s %9s %8s %7s' % (
+    'scenario', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'tokens', 'errors')
+
+
+def format_result(result):
+    return '%-20s %8d %9.0f %9.2f %9.2f %8d %7d' % (
+        result.name, result.requests, result.requests / result.elapsed,
+        (result.latency.percentile(50) or 0) * 1000,
+        (result.latency.percentile(99) or 0) * 1000,
+        result.token_fetches, result.errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('scenarios', nargs='*',
+                        help='scenarios to run, all of them by default: %s' %
+                        ', '.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: %s' % ', '.join(sorted(unknown)))
+
+    loop = asyncio.get_event_loop()
+    print(HEADER)
+    for name in args.scenarios or SCENARIOS:
+        result = loop.run_until_complete(
+            run(name, args.requests, args.concurrency))
+        print(format_result(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#
+# encoding: utf-8
+"""
+Fan-out of authorized requests with Client.request_many versus a naive
+asyncio.gather over Client.request.
+
+    python -m benchmarks.request_many [requests] [concurrency]
+"""
+import asyncio
+import sys
+import time
+
+from aioalf.client import Client
+
+from benchmarks.stubs import StubServer
+
+
+class InFlight(object):
+
+    def __init__(self, client):
+        self.current = 0
+        self.peak = 0
+        self._request = client.request
+        client.request = self.request
+
+    async def request(self, method, url, **kwargs):
+        self.current += 1
+        self.peak = max(self.peak, self.current)
+        try:
+            return await self._request(method, url, **kwargs)
+        finally:
+            self.current -= 1
+
+
+async def naive_gather(client, url, requests, concurrency):
+    async def one():
+        response = await client.request('GET', url)
+        await response.read()
+
+    await asyncio.gather(*[one() for _ in range(requests)])
+
+
+async def request_many(client, url, requests, concurrency):
+    specs = (('GET', url) for _ in range(requests))
+    async for _ in client.request_many(specs, concurrency=concurrency):
+        pass
+
+
+async def run(scenario, requests, concurrency):
+    server = await StubServer().start()
+    client = Client(token_endpoint=server.token_url,
+                    client_id='client-id', client_secret='secret')
+    in_flight = InFlight(client)
+
+    started = time.perf_counter()
+    await scenario(client, server.resource_url, requests, concurrency)
+    elapsed = time.perf_counter() - started
+
+    await client.close()
+    await server.stop()
+    return elapsed, in_flight.peak, server.token_fetches
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    loop = asyncio.get_event_loop()
+
+    for name, scenario in (('gather', naive_gather),
+                           ('request_many', request_many)):
+        elapsed, peak, fetches = loop.run_until_complete(
+            run(scenario, requests, concurrency))
+        print('%-13s %6d requests in %.2fs (%.0f req/s), peak in flight: '
+              '%5d, token fetches: %d' % (
+                  name, requests, elapsed, requests / elapsed, peak,
+                  fetches))
+
+
+if __name__ == '__main__':
+    main()
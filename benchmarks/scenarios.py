@@ -0,0 +1,152 @@
+#
+# encoding: utf-8
+"""
+Load scenarios for Client and TokenManager against the local stub server.
+
+Each scenario gets a started ``StubServer`` and a ``Stats`` to record every
+request in; ``run`` measures the whole scenario and reports throughput,
+latency percentiles and how many times the token endpoint was hit.
+"""
+import asyncio
+import time
+from collections import OrderedDict, namedtuple
+from functools import partial
+
+from aioalf.client import Client
+from aioalf.instrumentation import Histogram
+from aioalf.manager import TokenManager
+
+from benchmarks.stubs import StubServer
+
+Result = namedtuple('Result',
+                    'name requests elapsed latency token_fetches errors')
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+
+    async def request(self, client, url):
+        started = time.perf_counter()
+        try:
+            response = await client.request('GET', url)
+            await response.read()
+        except Exception:
+            self.errors += 1
+            return
+        self.latency.observe(time.perf_counter() - started)
+        if response.status != 200:
+            self.errors += 1
+
+
+class ShiftedClock(object):
+
+    def __init__(self):
+        self.offset = 0
+
+    def __call__(self):
+        return time.monotonic() + self.offset
+
+
+def make_client(server, **kwargs):
+    return Client(token_endpoint=server.token_url, client_id='client-id',
+                  client_secret='secret', **kwargs)
+
+
+async def fan_out(stats, client, url, requests, concurrency):
+    pending = iter(range(requests))
+
+    async def worker():
+        for _ in pending:
+            await stats.request(client, url)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+async def waves(stats, client, url, requests, concurrency, before_wave):
+    for _ in range(max(1, requests // concurrency)):
+        before_wave()
+        await asyncio.gather(*[stats.request(client, url)
+                               for _ in range(concurrency)])
+
+
+async def steady_state(server, stats, requests, concurrency):
+    async with make_client(server) as client:
+        await stats.request(client, server.resource_url)
+        await fan_out(stats, client, server.resource_url, requests - 1,
+                      concurrency)
+
+
+async def expiry_storm(server, stats, requests, concurrency):
+    # Every wave starts with the cached token expired, so ``concurrency``
+    # requests miss it at the same time.
+    clock = ShiftedClock()
+
+    class ExpiringClient(Client):
+        token_manager_class = partial(TokenManager, clock=clock)
+
+    async with ExpiringClient(token_endpoint=server.token_url,
+                              client_id='client-id',
+                              client_secret='secret') as client:
+        def expire():
+            clock.offset += server.expires_in
+
+        await waves(stats, client, server.resource_url, requests,
+                    concurrency, expire)
+
+
+async def unauthorized_storm(server, stats, requests, concurrency):
+    # Every wave starts with the cached token revoked, so ``concurrency``
+    # requests get a 401 for the same token.
+    server.check_tokens = True
+    async with make_client(server) as client:
+        await waves(stats, client, server.resource_url, requests,
+                    concurrency, server.revoke_tokens)
+
+
+async def shared_credential(server, stats, requests, concurrency):
+    clients = [make_client(server, shared_token=True)
+               for _ in range(concurrency)]
+    per_client = max(1, requests // concurrency)
+
+    async def one_client(client):
+        for _ in range(per_client):
+            await stats.request(client, server.resource_url)
+
+    try:
+        await asyncio.gather(*[one_client(client) for client in clients])
+    finally:
+        for client in clients:
+            await client.close()
+
+
+async def slow_auth_server(server, stats, requests, concurrency):
+    # An expiry storm against a token endpoint that takes 0.25s, so every
+    # wave waits on a slow refresh.
+    server.token_delay = 0.25
+    await expiry_storm(server, stats, requests, concurrency)
+
+
+SCENARIOS = OrderedDict([
+    ('steady_state', steady_state),
+    ('expiry_storm', expiry_storm),
+    ('unauthorized_storm', unauthorized_storm),
+    ('shared_credential', shared_credential),
+    ('slow_auth_server', slow_auth_server),
+])
+
+
+async def run(name, requests, concurrency):
+    server = await StubServer().start()
+    stats = Stats()
+    started = time.perf_counter()
+    try:
+        await SCENARIOS[name](server, stats, requests, concurrency)
+    finally:
+        elapsed = time.perf_counter() - started
+        await server.stop()
+
+    return Result(name, stats.latency.count + stats.errors, elapsed,
+                  stats.latency, server.token_fetches, stats.errors)
@@ -0,0 +1,76 @@
+#
+# encoding: utf-8
+import asyncio
+import itertools
+import json
+
+from aiohttp import web
+
+
+class StubServer(object):
+
+    def __init__(self, expires_in=3600, token_delay=0,
+                 resource_status=200, resource_delay=0, check_tokens=False):
+        self.expires_in = expires_in
+        self.token_delay = token_delay
+        self.resource_status = resource_status
+        self.resource_delay = resource_delay
+        self.check_tokens = check_tokens
+        self.valid_tokens = set()
+        self.token_fetches = 0
+        self.resource_requests = 0
+        self.rejected_requests = 0
+        self._tokens = itertools.count(1)
+        self._runner = None
+        self.port = None
+
+    @property
+    def token_url(self):
+        return 'http://127.0.0.1:%d/token' % self.port
+
+    @property
+    def resource_url(self):
+        return 'http://127.0.0.1:%d/resource' % self.port
+
+    async def token_handler(self, request):
+        self.token_fetches += 1
+        if self.token_delay:
+            await asyncio.sleep(self.token_delay)
+
+        access_token = 'token-%d' % next(self._tokens)
+        self.valid_tokens.add('Bearer %s' % access_token)
+        body = {
+            'access_token': access_token,
+            'expires_in': self.expires_in,
+        }
+        return web.Response(body=json.dumps(body),
+                            content_type='application/json')
+
+    async def resource_handler(self, request):
+        self.resource_requests += 1
+        if self.resource_delay:
+            await asyncio.sleep(self.resource_delay)
+        if self.check_tokens:
+            authorization = request.headers.get('Authorization')
+            if authorization not in self.valid_tokens:
+                self.rejected_requests += 1
+                return web.Response(status=401, text='invalid token')
+        return web.Response(status=self.resource_status, text='ok')
+
+    def revoke_tokens(self):
+        self.valid_tokens.clear()
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/token', self.token_handler)
+        app.router.add_route('*', '/resource', self.resource_handler)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        return self
+
+    async def stop(self):
+        await self._runner.cleanup()
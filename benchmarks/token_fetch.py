@@ -0,0 +1,64 @@
+#
+# encoding: utf-8
+"""
+Token endpoint latency with a throwaway session per request versus the
+pooled keep-alive session owned by TokenManager.
+
+    python -m benchmarks.token_fetch [requests]
+"""
+import asyncio
+import statistics
+import sys
+import time
+
+from aiohttp import ClientSession
+
+from aioalf.manager import TokenManager
+
+from benchmarks.stubs import StubServer
+
+
+class SessionPerRequestTokenManager(TokenManager):
+
+    async def _fetch(self, url, method="GET", data=None, headers=None):
+        self._session = ClientSession()
+        try:
+            return await super()._fetch(url, method, data, headers)
+        finally:
+            await self._session.close()
+            self._session = None
+
+
+async def run(manager_class, requests):
+    server = await StubServer().start()
+    manager = manager_class(server.token_url, 'client-id', 'secret')
+
+    latencies = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        await manager._request_token()
+        latencies.append(time.perf_counter() - started)
+
+    await manager.close()
+    await server.stop()
+    return latencies
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    loop = asyncio.get_event_loop()
+
+    for name, manager_class in (('per-request', SessionPerRequestTokenManager),
+                                ('pooled', TokenManager)):
+        latencies = sorted(loop.run_until_complete(
+            run(manager_class, requests)))
+        print('%-12s %5d token requests, mean: %.3fms, p50: %.3fms, '
+              'p99: %.3fms' % (
+                  name, requests,
+                  statistics.mean(latencies) * 1000,
+                  latencies[len(latencies) // 2] * 1000,
+                  latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+if __name__ == '__main__':
+    main()
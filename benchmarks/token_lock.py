@@ -0,0 +1,87 @@
+#
+# encoding: utf-8
+"""
+Lock contention on TokenManager.get_token with a valid cached token.
+
+    python -m benchmarks.token_lock [concurrency]
+
+Warms the token up, then runs ``concurrency`` simultaneous
+``Client.request`` calls against a local stub and reports how many times
+the token lock was taken and how long callers waited on it, comparing the
+old always-lock read path with the current lock-free one.
+"""
+import asyncio
+import sys
+import time
+
+from aioalf.client import Client
+from aioalf.manager import TokenManager
+
+from benchmarks.stubs import StubServer
+
+
+class CountingLock(asyncio.Lock):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquisitions = 0
+        self.wait_time = 0.0
+
+    async def acquire(self):
+        started = time.perf_counter()
+        result = await super().acquire()
+        self.wait_time += time.perf_counter() - started
+        self.acquisitions += 1
+        return result
+
+
+class AlwaysLockTokenManager(TokenManager):
+
+    async def get_token(self):
+        async with self._token_lock:
+            if not self._has_token():
+                await self._update_token()
+            return self._token.access_token
+
+
+async def run(manager_class, concurrency):
+    server = await StubServer().start()
+
+    class BenchClient(Client):
+        token_manager_class = manager_class
+
+    client = BenchClient(token_endpoint=server.token_url,
+                         client_id='client-id', client_secret='secret')
+
+    async def one():
+        response = await client.request('GET', server.resource_url)
+        await response.read()
+
+    await one()
+    lock = client._token_manager._token_lock = CountingLock()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    await client.close()
+    await server.stop()
+    return elapsed, lock, server.token_fetches
+
+
+def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    loop = asyncio.get_event_loop()
+
+    for name, manager_class in (('always-lock', AlwaysLockTokenManager),
+                                ('lock-free', TokenManager)):
+        elapsed, lock, fetches = loop.run_until_complete(
+            run(manager_class, concurrency))
+        print('%-12s %6d requests in %.2fs, lock acquisitions: %6d, '
+              'lock wait: %.3fs, token fetches: %d' % (
+                  name, concurrency, elapsed, lock.acquisitions,
+                  lock.wait_time, fetches))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+#
+# encoding: utf-8
+"""
+Token.is_valid calls per second, datetime.utcnow based versus the
+monotonic deadline.
+
+    python -m benchmarks.token_validity [iterations]
+"""
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from aioalf.token import Token
+
+
+class DatetimeToken(object):
+
+    def __init__(self, access_token='', expires_in=0):
+        self.access_token = access_token
+        self._expires_in = expires_in
+
+        self.expires_on = datetime.utcnow() + timedelta(
+            seconds=int(self._expires_in))
+
+    def is_valid(self):
+        return self.expires_on > datetime.utcnow()
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    for name, token_class in (('datetime', DatetimeToken),
+                              ('monotonic', Token)):
+        token = token_class('access_token', 3600)
+        elapsed = timeit.timeit(token.is_valid, number=iterations)
+        print('%-10s %12.0f is_valid calls/s' % (name, iterations / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -39,6 +39,7 @@ setup(
     packages=find_packages(
         exclude=(
             'tests',
+            'benchmarks',
         ),
     ),
     include_package_data=True,
@@ -47,5 +48,7 @@ setup(
     ],
     extras_require={
         'tests': tests_require,
+        'keyring': ['keyring'],
+        'orjson': ['orjson'],
     },
 )
@@ -1,9 +1,12 @@
 #
 # encoding: utf-8
 
+import asyncio
+import json
 from unittest import TestCase, mock
 from yarl import URL
-from aiohttp import ClientResponse, __version__ as aiohttp_version
+from aiohttp import ClientResponse, web, __version__ as aiohttp_version
+from aiohttp.test_utils import TestServer
 from distutils.version import LooseVersion
 
 
@@ -27,7 +30,7 @@ class AsyncTestCase(TestCase):
 
 
 def make_response(loop, method, url, data=None,
-                  content_type='text/plain', charset='utf-8'):
+                  content_type='text/plain', charset='utf-8', status=200):
     if LooseVersion(aiohttp_version) >= LooseVersion('3.3.0'):
         response = ClientResponse(method, URL(url),
                                   writer=mock.Mock(),
@@ -67,8 +70,129 @@ def make_response(loop, method, url, data=None,
     else:
         response.headers = {
             'Content-Type': '%s; charset=%s' % (content_type, charset)}
+    response.status = status
     content = response.content = mock.Mock()
     if data:
         content.read.side_effect = side_effect
 
     return response
+
+
+class StubAuthServer(object):
+
+    def __init__(self, loop, expires_in=3600):
+        self.loop = loop
+        self.expires_in = expires_in
+        self.token_fetches = 0
+        self.valid_tokens = set()
+        self.failures = 0
+        self.token_delay = 0
+        self.uploads = []
+        self.challenge = None
+        self.throttle = None
+        self.cache_control = 'max-age=60'
+        self.cached_requests = []
+        self.slow_body_delay = 3
+        self.token_scopes = []
+        self.token_requests = []
+        self.issue_refresh_tokens = False
+        self.refresh_tokens = set()
+        self.reissue_token = None
+        self.server = None
+
+    async def token_handler(self, request):
+        if self.token_delay:
+            await asyncio.sleep(self.token_delay)
+        if self.failures:
+            self.failures -= 1
+            return web.Response(status=503, text='unavailable')
+
+        form = await request.post()
+        self.token_requests.append(dict(form))
+        self.token_scopes.append(form.get('scope'))
+        if form.get('grant_type') == 'refresh_token':
+            if form.get('refresh_token') not in self.refresh_tokens:
+                return web.json_response({'error': 'invalid_grant'},
+                                         status=400)
+
+        self.token_fetches += 1
+        access_token = self.reissue_token or 'token-%d' % self.token_fetches
+        self.valid_tokens.add(access_token)
+        body = {'access_token': access_token, 'expires_in': self.expires_in}
+        if self.issue_refresh_tokens:
+            body['refresh_token'] = 'refresh-%d' % self.token_fetches
+            self.refresh_tokens.add(body['refresh_token'])
+        return web.Response(body=json.dumps(body),
+                            content_type='application/json')
+
+    async def resource_handler(self, request):
+        await request.read()
+        if self.throttle is not None:
+            retry_after, self.throttle = self.throttle, None
+            return web.Response(status=429,
+                                headers={'Retry-After': retry_after})
+        if self.challenge is not None:
+            return web.Response(
+                status=401, headers={'WWW-Authenticate': self.challenge})
+        if not self._authorized(request):
+            return web.Response(status=401)
+        return web.Response(text='ok')
+
+    async def slow_handler(self, request):
+        if self._authorized(request):
+            return web.Response(text='ok')
+        response = web.StreamResponse(status=401)
+        await response.prepare(request)
+        await response.write(b'unauthorized, ')
+        await asyncio.sleep(self.slow_body_delay)
+        await response.write(b'eventually')
+        return response
+
+    async def cached_handler(self, request):
+        if not self._authorized(request):
+            return web.Response(status=401)
+        etag = request.headers.get('If-None-Match')
+        self.cached_requests.append(etag)
+        headers = {'ETag': '"v1"', 'Cache-Control': self.cache_control}
+        if etag == '"v1"':
+            return web.Response(status=304, headers=headers)
+        return web.Response(text='cached', headers=headers)
+
+    def _authorized(self, request):
+        authorization = request.headers.get('Authorization', '')
+        return authorization[len('Bearer '):] in self.valid_tokens
+
+    async def upload_expect_handler(self, request):
+        if not self._authorized(request):
+            raise web.HTTPUnauthorized()
+        await request.writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+    async def upload_handler(self, request):
+        body = await request.read()
+        if not self._authorized(request):
+            return web.Response(status=401)
+        self.uploads.append(body)
+        return web.Response(text='ok')
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/token', self.token_handler)
+        app.router.add_route('*', '/resource', self.resource_handler)
+        app.router.add_route('*', '/cached', self.cached_handler)
+        app.router.add_get('/slow', self.slow_handler)
+        app.router.add_post('/upload', self.upload_handler,
+                            expect_handler=self.upload_expect_handler)
+        return app
+
+    async def start(self):
+        self.server = TestServer(self.make_app())
+        await self.server.start_server(loop=self.loop)
+        self.token_endpoint = str(self.server.make_url('/token'))
+        self.resource_url = str(self.server.make_url('/resource'))
+        self.upload_url = str(self.server.make_url('/upload'))
+        self.cached_url = str(self.server.make_url('/cached'))
+        self.slow_url = str(self.server.make_url('/slow'))
+        return self
+
+    async def close(self):
+        await self.server.close()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from unittest import TestCase
+from asynctest import CoroutineMock, Mock
+from . import AsyncTestCase
+from aiohttp.test_utils import unittest_run_loop
+from aioalf.batch import parse_spec, run_batch
+
+
+class TestParseSpec(TestCase):
+
+    def test_should_accept_method_and_url(self):
+        self.assertEqual(parse_spec(('GET', 'http://api')),
+                         ('GET', 'http://api', {}))
+
+    def test_should_accept_request_kwargs(self):
+        self.assertEqual(parse_spec(('POST', 'http://api', {'data': 'x'})),
+                         ('POST', 'http://api', {'data': 'x'}))
+
+    def test_should_accept_dicts(self):
+        self.assertEqual(
+            parse_spec({'method': 'GET', 'url': 'http://api', 'params': {}}),
+            ('GET', 'http://api', {'params': {}}))
+
+
+class TestRunBatch(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+
+    async def fake_request(self, method, url, **kwargs):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.001)
+        finally:
+            self.in_flight -= 1
+        if url == 'http://api/fail':
+            raise ValueError('boom')
+        response = Mock(status=200, url=url)
+        response.read = CoroutineMock()
+        return response
+
+    async def _collect(self, requests, **kwargs):
+        return [result async for result
+                in run_batch(self.fake_request, requests, **kwargs)]
+
+    @unittest_run_loop
+    async def test_should_return_every_result(self):
+        specs = [('GET', 'http://api/%d' % n) for n in range(50)]
+
+        results = await self._collect(specs, concurrency=5)
+
+        self.assertEqual(sorted(r.index for r in results), list(range(50)))
+        for result in results:
+            self.assertEqual(result.url, 'http://api/%d' % result.index)
+            self.assertEqual(result.response.status, 200)
+            result.response.read.assert_called_once()
+
+    @unittest_run_loop
+    async def test_should_bound_concurrency(self):
+        specs = [('GET', 'http://api/%d' % n) for n in range(50)]
+
+        await self._collect(specs, concurrency=5)
+
+        self.assertEqual(self.max_in_flight, 5)
+
+    @unittest_run_loop
+    async def test_should_accept_async_iterables(self):
+        async def specs():
+            for n in range(20):
+                yield ('GET', 'http://api/%d' % n)
+
+        results = await self._collect(specs(), concurrency=3)
+
+        self.assertEqual(sorted(r.index for r in results), list(range(20)))
+
+    @unittest_run_loop
+    async def test_should_report_request_errors_as_results(self):
+        specs = [('GET', 'http://api/ok'), ('GET', 'http://api/fail')]
+
+        results = await self._collect(specs, concurrency=2)
+        failed = [r for r in results if r.exception is not None]
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0].url, 'http://api/fail')
+        self.assertIsNone(failed[0].response)
+
+    @unittest_run_loop
+    async def test_should_not_read_bodies_when_asked_not_to(self):
+        results = await self._collect([('GET', 'http://api/ok')], read=False)
+
+        results[0].response.read.assert_not_called()
+
+    @unittest_run_loop
+    async def test_should_raise_errors_from_the_source(self):
+        def specs():
+            yield ('GET', 'http://api/ok')
+            raise RuntimeError('bad source')
+
+        with self.assertRaises(RuntimeError):
+            await self._collect(specs(), concurrency=2)
+
+    @unittest_run_loop
+    async def test_should_stop_workers_when_the_consumer_stops(self):
+        pulled = []
+
+        def specs():
+            for n in range(1000):
+                pulled.append(n)
+                yield ('GET', 'http://api/%d' % n)
+
+        batch = run_batch(self.fake_request, specs(), concurrency=2)
+        async for result in batch:
+            break
+        await batch.aclose()
+        await asyncio.sleep(0.01)
+
+        self.assertLess(len(pulled), 10)
+        self.assertLess(self.calls, 10)
+        self.assertEqual(self.in_flight, 0)
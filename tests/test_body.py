@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import io
+
+from . import AsyncTestCase
+from aiohttp.test_utils import unittest_run_loop
+from aioalf.body import prepare_body, StreamingBody
+
+
+async def chunks(count, size=10):
+    for n in range(count):
+        yield bytes([n]) * size
+
+
+class NotSeekable(io.RawIOBase):
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+
+class TestPrepareBody(AsyncTestCase):
+
+    @unittest_run_loop
+    async def test_plain_bodies_should_be_replayable(self):
+        for data in (None, b'data', 'data', {'key': 'value'}):
+            kwargs = {'data': data}
+            body = await prepare_body(kwargs)
+
+            self.assertTrue(body.can_replay())
+            self.assertIs(kwargs['data'], data)
+
+    @unittest_run_loop
+    async def test_small_files_should_be_buffered(self):
+        data = io.BytesIO(b'0123456789')
+        data.seek(2)
+        kwargs = {'data': data}
+        body = await prepare_body(kwargs)
+
+        self.assertTrue(body.can_replay())
+        self.assertEqual(kwargs['data'], b'23456789')
+
+    @unittest_run_loop
+    async def test_large_files_should_be_rewound(self):
+        data = io.BytesIO(b'0123456789')
+        data.seek(2)
+        headers = {'Content-Type': 'text/plain'}
+        kwargs = {'data': data, 'headers': headers}
+        body = await prepare_body(kwargs, buffer_size=4)
+
+        self.assertIs(kwargs['data'], data)
+        self.assertTrue(kwargs['expect100'])
+        self.assertEqual(kwargs['headers']['Connection'], 'close')
+        self.assertEqual(headers, {'Content-Type': 'text/plain'})
+
+        data.read()
+        body.rewind()
+
+        self.assertTrue(body.can_replay())
+        self.assertEqual(data.read(), b'23456789')
+
+        data.close()
+        self.assertFalse(body.can_replay())
+
+    @unittest_run_loop
+    async def test_not_seekable_files_should_not_be_replayable(self):
+        body = await prepare_body({'data': NotSeekable()})
+
+        self.assertFalse(body.can_replay())
+
+    @unittest_run_loop
+    async def test_small_streams_should_be_buffered(self):
+        kwargs = {'data': chunks(3)}
+        body = await prepare_body(kwargs, buffer_size=100)
+
+        self.assertTrue(body.can_replay())
+        self.assertEqual(kwargs['data'],
+                         b'\x00' * 10 + b'\x01' * 10 + b'\x02' * 10)
+        self.assertNotIn('expect100', kwargs)
+
+    @unittest_run_loop
+    async def test_large_streams_should_keep_streaming(self):
+        kwargs = {'data': chunks(100)}
+        body = await prepare_body(kwargs, buffer_size=25)
+
+        self.assertIsInstance(body, StreamingBody)
+        self.assertIs(kwargs['data'], body)
+        self.assertTrue(kwargs['expect100'])
+        self.assertEqual(len(body._chunks), 3)
+        self.assertTrue(body.can_replay())
+
+        sent = [chunk async for chunk in body]
+
+        self.assertEqual(len(sent), 100)
+        self.assertEqual(sent[99], b'\x63' * 10)
+        self.assertFalse(body.can_replay())
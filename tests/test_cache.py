@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+from aiohttp import ClientResponseError
+from asynctest import CoroutineMock, Mock
+from multidict import CIMultiDict
+from . import AsyncTestCase, StubAuthServer
+from aiohttp.test_utils import unittest_run_loop
+from aioalf.cache import (CacheEntry, DiskCacheBackend, MemoryCacheBackend,
+                          ResponseCache, credential_identity,
+                          parse_cache_control, request_url)
+from aioalf.client import Client
+from aioalf.instrumentation import Instrumentation, MetricsCollector
+
+
+def make_response(status=200, body=b'body', method='GET', **headers):
+    response = Mock(status=status, reason='OK', method=method,
+                    headers=CIMultiDict(headers))
+    response.read = CoroutineMock(return_value=body)
+    return response
+
+
+def make_entry(body=b'body', response_time=100.0, **headers):
+    return CacheEntry(200, headers, body, response_time=response_time)
+
+
+class TestCacheEntry(AsyncTestCase):
+
+    def test_parse_cache_control(self):
+        self.assertEqual(
+            parse_cache_control('max-age=60, No-Cache, private="x"'),
+            {'max-age': '60', 'no-cache': None, 'private': 'x'})
+        self.assertEqual(parse_cache_control(None), {})
+
+    def test_request_url_should_merge_params_like_aiohttp(self):
+        self.assertEqual(request_url('http://a/b?x=1', {'y': '2'}),
+                         'http://a/b?x=1&y=2')
+
+    def test_identity_should_not_depend_on_scope_order(self):
+        self.assertEqual(credential_identity('e', 'c', 's', ['b', 'a']),
+                         credential_identity('e', 'c', 's', 'a b'))
+        self.assertNotEqual(credential_identity('e', 'c', 's', 'a'),
+                            credential_identity('e', 'other', 's', 'a'))
+
+    def test_identity_should_depend_on_the_secret(self):
+        identity = credential_identity('e', 'c', 'secret')
+
+        self.assertNotEqual(identity, credential_identity('e', 'c', 'WRONG'))
+        self.assertNotIn('secret', identity)
+
+    def test_max_age_freshness(self):
+        entry = make_entry(**{'Cache-Control': 'max-age=60', 'Age': '10'})
+
+        self.assertTrue(entry.is_fresh(149.0))
+        self.assertFalse(entry.is_fresh(150.0))
+
+    def test_expires_freshness(self):
+        entry = make_entry(Date='Mon, 01 Jan 2024 00:00:00 GMT',
+                           Expires='Mon, 01 Jan 2024 00:00:30 GMT')
+
+        self.assertEqual(entry.freshness_lifetime(), 30)
+
+    def test_no_cache_responses_are_never_fresh(self):
+        entry = make_entry(**{'Cache-Control': 'max-age=60, no-cache'})
+        self.assertFalse(entry.is_fresh(100.0))
+
+    def test_should_match_vary_headers(self):
+        response = make_response(Vary='Accept')
+        entry = CacheEntry.from_response(
+            response, b'', CIMultiDict(accept='text/plain'), 100.0)
+
+        self.assertTrue(entry.matches(CIMultiDict(Accept='text/plain')))
+        self.assertFalse(entry.matches(CIMultiDict(Accept='text/html')))
+
+    def test_should_describe_the_decoded_body(self):
+        response = make_response(**{'Content-Encoding': 'gzip',
+                                    'Content-Length': '10'})
+        entry = CacheEntry.from_response(response, b'decoded body',
+                                         CIMultiDict(), 100.0)
+
+        self.assertNotIn('Content-Encoding', entry.headers)
+        self.assertEqual(entry.headers['Content-Length'], '12')
+
+    def test_should_keep_the_content_length_of_head_responses(self):
+        response = make_response(method='HEAD', **{'Content-Length': '10'})
+        entry = CacheEntry.from_response(response, b'', CIMultiDict(), 100.0)
+
+        self.assertEqual(entry.headers['Content-Length'], '10')
+
+    def test_cached_responses_should_raise_for_status(self):
+        make_entry().response('GET', 'http://a/r', 100.0).raise_for_status()
+
+        entry = CacheEntry(404, {}, b'', reason='Not Found')
+        with self.assertRaises(ClientResponseError) as context:
+            entry.response('GET', 'http://a/r', 100.0).raise_for_status()
+        self.assertEqual(context.exception.status, 404)
+
+
+class TestMemoryCacheBackend(AsyncTestCase):
+
+    @unittest_run_loop
+    async def test_should_evict_least_recently_used_entries_by_size(self):
+        backend = MemoryCacheBackend(max_size=250)
+        for key in 'abc':
+            await backend.set(key, make_entry(b'x' * 100))
+            await backend.get('a')
+
+        self.assertIsNotNone(await backend.get('a'))
+        self.assertIsNone(await backend.get('b'))
+        self.assertIsNotNone(await backend.get('c'))
+        self.assertEqual(backend.size, 200)
+
+    @unittest_run_loop
+    async def test_should_not_store_entries_larger_than_the_cache(self):
+        backend = MemoryCacheBackend(max_size=10)
+        await backend.set('a', make_entry(b'x' * 100))
+        self.assertEqual(len(backend), 0)
+
+
+class TestDiskCacheBackend(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.directory = tempfile.mkdtemp()
+
+    async def tearDownAsync(self):
+        shutil.rmtree(self.directory)
+
+    @unittest_run_loop
+    async def test_should_store_entries_in_files(self):
+        backend = DiskCacheBackend(self.directory)
+        entry = CacheEntry.from_response(
+            make_response(Vary='Accept', ETag='"1"'), b'\x00body\n',
+            CIMultiDict(Accept='a'), 100.0)
+        await backend.set('key', entry)
+
+        loaded = await DiskCacheBackend(self.directory).get('key')
+        self.assertEqual(loaded.body, b'\x00body\n')
+        self.assertEqual(loaded.headers['ETag'], '"1"')
+        self.assertEqual(loaded.vary, {'accept': 'a'})
+        self.assertEqual(loaded.response_time, 100.0)
+
+        await backend.delete('key')
+        await backend.delete('key')
+        self.assertIsNone(await backend.get('key'))
+
+    @unittest_run_loop
+    async def test_should_evict_the_oldest_files(self):
+        backend = DiskCacheBackend(self.directory, max_size=None)
+        for index, key in enumerate('abc'):
+            await backend.set(key, make_entry(b'x' * 250))
+            os.utime(backend._path(key), (index, index))
+        backend.max_size = 3 * os.path.getsize(backend._path('a'))
+
+        await backend.set('d', make_entry(b'x' * 250))
+
+        self.assertIsNone(await backend.get('a'))
+        self.assertIsNotNone(await backend.get('b'))
+        self.assertIsNotNone(await backend.get('c'))
+        self.assertIsNotNone(await backend.get('d'))
+
+    def test_should_refuse_a_directory_others_can_write_to(self):
+        os.chmod(self.directory, 0o777)
+
+        with self.assertRaises(RuntimeError):
+            DiskCacheBackend(self.directory)
+
+    def test_should_require_a_directory(self):
+        with self.assertRaises(TypeError):
+            DiskCacheBackend()
+
+
+class TestResponseCache(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.now = 100.0
+        self.instrumentation = Instrumentation()
+        self.metrics = MetricsCollector(self.instrumentation)
+        self.cache = ResponseCache(clock=lambda: self.now,
+                                   instrumentation=self.instrumentation)
+        self.send = CoroutineMock()
+
+    async def _get(self, identity='me', **kwargs):
+        return await self.cache.fetch(self.send, identity, 'GET',
+                                      'http://a/r', **kwargs)
+
+    def _outcomes(self):
+        return self.metrics.snapshot()['counters']
+
+    @unittest_run_loop
+    async def test_should_serve_fresh_responses_from_the_cache(self):
+        self.send.return_value = make_response(
+            **{'Cache-Control': 'max-age=60', 'Content-Type': 'text/plain'})
+
+        await self._get()
+        self.now = 150.0
+        response = await self._get()
+
+        self.assertEqual(self.send.call_count, 1)
+        self.assertTrue(response.from_cache)
+        self.assertEqual(await response.text(), 'body')
+        self.assertEqual(response.headers['Age'], '50')
+        self.assertEqual(self._outcomes(), {'response_cache.miss': 1,
+                                            'response_cache.hit': 1})
+
+    @unittest_run_loop
+    async def test_should_revalidate_stale_responses(self):
+        self.send.return_value = make_response(
+            ETag='"1"', **{'Cache-Control': 'max-age=10'})
+        await self._get()
+
+        self.now = 200.0
+        not_modified = make_response(304, ETag='"1"',
+                                     **{'Cache-Control': 'max-age=30'})
+        self.send.return_value = not_modified
+        response = await self._get()
+
+        self.assertEqual(self.send.call_args[1]['headers']['If-None-Match'],
+                         '"1"')
+        not_modified.release.assert_called_once_with()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.read(), b'body')
+
+        self.now = 229.0
+        await self._get()
+        self.assertEqual(self.send.call_count, 2)
+
+    @unittest_run_loop
+    async def test_should_revalidate_with_last_modified(self):
+        modified = 'Mon, 01 Jan 2024 00:00:00 GMT'
+        self.send.return_value = make_response(**{'Last-Modified': modified})
+        await self._get()
+        await self._get()
+
+        self.assertEqual(
+            self.send.call_args[1]['headers']['If-Modified-Since'], modified)
+
+    @unittest_run_loop
+    async def test_should_keep_entries_apart_by_identity(self):
+        self.send.return_value = make_response(
+            **{'Cache-Control': 'max-age=60'})
+
+        await self._get('me')
+        await self._get('someone else')
+
+        self.assertEqual(self.send.call_count, 2)
+
+    @unittest_run_loop
+    async def test_should_not_store_uncacheable_responses(self):
+        for headers in ({'Cache-Control': 'no-store, max-age=60'},
+                        {'Cache-Control': 'max-age=60', 'Vary': '*'},
+                        {}):
+            self.send.return_value = make_response(**headers)
+            await self._get()
+            await self._get()
+
+        self.send.return_value = make_response(
+            500, **{'Cache-Control': 'max-age=60'})
+        await self._get()
+        await self._get()
+
+        self.assertEqual(self.send.call_count, 8)
+
+    @unittest_run_loop
+    async def test_should_honor_request_cache_control(self):
+        self.send.return_value = make_response(
+            ETag='"1"', **{'Cache-Control': 'max-age=60'})
+        await self._get()
+        self.now = 110.0
+
+        await self._get(headers={'Cache-Control': 'no-cache'})
+        self.now = 120.0
+        await self._get(headers={'Cache-Control': 'max-age=5'})
+        self.assertEqual(self.send.call_count, 3)
+
+        await self._get(headers={'Cache-Control': 'no-store'})
+        self.assertNotIn('If-None-Match', self.send.call_args[1]['headers'])
+
+    @unittest_run_loop
+    async def test_unsafe_methods_should_invalidate_the_url(self):
+        self.send.return_value = make_response(
+            **{'Cache-Control': 'max-age=60'})
+        await self._get()
+
+        await self.cache.fetch(self.send, 'me', 'POST', 'http://a/r',
+                               data=b'x')
+        await self._get()
+
+        self.assertEqual(self.send.call_count, 3)
+
+    @unittest_run_loop
+    async def test_head_should_not_be_served_from_a_get(self):
+        self.send.return_value = make_response(
+            **{'Cache-Control': 'max-age=60'})
+        await self._get()
+        await self.cache.fetch(self.send, 'me', 'HEAD', 'http://a/r')
+
+        self.assertEqual(self.send.call_count, 2)
+
+
+class TestClientCache(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.server = await StubAuthServer(self.loop).start()
+        self.cache = ResponseCache()
+
+    async def tearDownAsync(self):
+        await self.server.close()
+
+    def _client(self, client_id='client_id', scope=None,
+                client_secret='client_secret'):
+        return Client(token_endpoint=self.server.token_endpoint,
+                      client_id=client_id, client_secret=client_secret,
+                      scope=scope, cache=self.cache)
+
+    @unittest_run_loop
+    async def test_should_skip_the_token_and_the_request_on_a_hit(self):
+        async with self._client() as client:
+            first = await client.request('GET', self.server.cached_url)
+            second = await client.request('GET', self.server.cached_url)
+
+        self.assertEqual(await first.text(), 'cached')
+        self.assertEqual(await second.text(), 'cached')
+        self.assertEqual(self.server.cached_requests, [None])
+        self.assertEqual(self.server.token_fetches, 1)
+
+    @unittest_run_loop
+    async def test_should_revalidate_with_the_server(self):
+        self.server.cache_control = 'no-cache'
+        async with self._client() as client:
+            await client.request('GET', self.server.cached_url)
+            response = await client.request('GET', self.server.cached_url)
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.text(), 'cached')
+        self.assertEqual(self.server.cached_requests, [None, '"v1"'])
+
+    @unittest_run_loop
+    async def test_should_not_share_responses_across_credentials(self):
+        clients = [self._client(), self._client('other'),
+                   self._client(scope='admin')]
+        for client in clients:
+            await client.request('GET', self.server.cached_url)
+            await client.close()
+
+        self.assertEqual(self.server.cached_requests, [None] * 3)
+        self.assertEqual(self.server.token_fetches, 3)
+
+    @unittest_run_loop
+    async def test_should_not_serve_a_hit_to_a_wrong_secret(self):
+        async with self._client() as client:
+            await client.request('GET', self.server.cached_url)
+        async with self._client(client_secret='WRONG') as client:
+            await client.request('GET', self.server.cached_url)
+
+        self.assertEqual(self.server.cached_requests, [None, None])
+        self.assertEqual(len(self.server.token_requests), 2)
@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 
-from asynctest import patch, CoroutineMock
-from . import AsyncTestCase
+import asyncio
+import io
+import os
+from functools import partial
+from unittest import TestCase
+
+from aiohttp import TCPConnector
+from asynctest import patch, CoroutineMock, MagicMock
+from . import AsyncTestCase, StubAuthServer
 
 from aiohttp.test_utils import unittest_run_loop
 from aioalf.manager import TokenManager, TokenHTTPError, TokenError
-from aioalf.client import Client
+from aioalf.client import (Client, _host_name, is_token_rejected,
+                           parse_www_authenticate)
+from aioalf.policy import CircuitBreaker
+from aioalf.registry import TokenManagerRegistry
 
 
 class TestClient(AsyncTestCase):
@@ -34,6 +44,142 @@ class TestClient(AsyncTestCase):
 
         close_mock.assert_called_once()
 
+    @unittest_run_loop
+    async def test_should_build_connector_from_options(self):
+        client = Client(token_endpoint=self.end_point,
+                        client_id='client-id', client_secret='client_secret',
+                        connector_options={'limit': 50, 'limit_per_host': 10,
+                                           'keepalive_timeout': 30,
+                                           'ttl_dns_cache': 300})
+        connector = client._http_client.connector
+
+        self.assertEqual(connector.limit, 50)
+        self.assertEqual(connector.limit_per_host, 10)
+        await client.close()
+        self.assertTrue(connector.closed)
+
+    @unittest_run_loop
+    async def test_should_not_close_a_shared_connector(self):
+        connector = TCPConnector(limit=20)
+        clients = [Client(token_endpoint=self.end_point,
+                          client_id='client-id', client_secret='client_secret',
+                          connector=connector) for _ in range(2)]
+
+        for client in clients:
+            self.assertIs(client._http_client.connector, connector)
+            await client.close()
+
+        self.assertFalse(connector.closed)
+        await connector.close()
+
+    @unittest_run_loop
+    async def test_manager_should_share_the_client_session(self):
+        async with Client(token_endpoint=self.end_point,
+                          client_id='client-id',
+                          client_secret='client_secret') as client:
+            self.assertIs(client._token_manager._get_session(),
+                          client._http_client)
+
+    @unittest_run_loop
+    async def test_should_not_pass_a_session_to_managers_without_one(self):
+        class LegacyManager(TokenManager):
+            def __init__(self, token_endpoint, client_id, client_secret,
+                         http_options=None, scope=None):
+                super().__init__(token_endpoint, client_id, client_secret,
+                                 http_options=http_options, scope=scope)
+
+        class ClientTest(Client):
+            token_manager_class = LegacyManager
+
+        async with ClientTest(token_endpoint=self.end_point,
+                              client_id='client-id',
+                              client_secret='client_secret') as client:
+            self.assertIsNot(client._token_manager._get_session(),
+                             client._http_client)
+
+    @unittest_run_loop
+    async def test_manager_should_share_the_session_through_a_partial(self):
+        class ClientTest(Client):
+            token_manager_class = partial(TokenManager, refresh_ratio=0.8)
+
+        async with ClientTest(token_endpoint=self.end_point,
+                              client_id='client-id',
+                              client_secret='client_secret') as client:
+            self.assertIs(client._token_manager._get_session(),
+                          client._http_client)
+
+    @unittest_run_loop
+    async def test_manager_can_use_its_own_session(self):
+        async with Client(token_endpoint=self.end_point,
+                          client_id='client-id',
+                          client_secret='client_secret',
+                          share_session=False) as client:
+            session = client._token_manager._get_session()
+            self.assertIsNot(session, client._http_client)
+
+        self.assertTrue(session.closed)
+
+    @unittest_run_loop
+    async def test_clients_can_share_a_token_manager(self):
+        registry = TokenManagerRegistry()
+
+        class ClientTest(Client):
+            token_manager_registry = registry
+
+        first = ClientTest(token_endpoint=self.end_point,
+                           client_id='client-id', client_secret='client_secret',
+                           scope='user', shared_token=True)
+        second = ClientTest(token_endpoint=self.end_point,
+                            client_id='client-id', client_secret='client_secret',
+                            scope='user', shared_token=True)
+
+        self.assertIs(first._token_manager, second._token_manager)
+        self.assertIsNot(first._token_manager._get_session(),
+                         first._http_client)
+
+        await first.close()
+        self.assertEqual(len(registry), 1)
+        await second.close()
+        self.assertEqual(len(registry), 0)
+
+    @unittest_run_loop
+    async def test_closing_a_client_twice_should_release_its_manager_once(
+            self):
+        registry = TokenManagerRegistry()
+
+        class ClientTest(Client):
+            token_manager_registry = registry
+
+        options = dict(token_endpoint=self.end_point, client_id='client-id',
+                       client_secret='client_secret', shared_token=True)
+        first = ClientTest(**options)
+        second = ClientTest(**options)
+
+        async with first:
+            pass
+        await first.close()
+
+        self.assertEqual(len(registry), 1)
+        third = ClientTest(**options)
+        self.assertIs(third._token_manager, second._token_manager)
+        await second.close()
+        await third.close()
+        self.assertEqual(len(registry), 0)
+
+    @unittest_run_loop
+    @patch('aioalf.client.TokenManager')
+    async def test_close_should_close_the_token_manager(self, Manager):
+        manager = self._fake_manager(Manager)
+
+        class ClientTest(Client):
+            token_manager_class = Manager
+
+        client = ClientTest(token_endpoint=self.end_point,
+                            client_id='client-id', client_secret='client_secret')
+        await client.close()
+
+        manager.close.assert_called_once()
+
     @unittest_run_loop
     @patch('aioalf.client.TokenManager')
     async def test_should_return_a_good_request(self, Manager):
@@ -67,7 +213,7 @@ class TestClient(AsyncTestCase):
 
         with patch('aioalf.client.Client._authorized_fetch') as _authorized_fetch:
 
-            _authorized_fetch.return_value = CoroutineMock(status=401)
+            _authorized_fetch.return_value = self._unauthorized()
             response = await self._request(Manager)
             self.assertEqual(response.status, 401)
             self.assertEqual(_authorized_fetch.call_count, 2)
@@ -79,14 +225,84 @@ class TestClient(AsyncTestCase):
 
         with patch('aioalf.client.Client._authorized_fetch') as _authorized_fetch:
 
-            _authorized_fetch.return_value = CoroutineMock(status=401)
+            _authorized_fetch.return_value = self._unauthorized()
             response = await self._request(Manager)
             self.assertEqual(response.status, 401)
             self.assertEqual(manager.reset_token.call_count, 1)
 
     @unittest_run_loop
     @patch('aioalf.client.TokenManager')
-    async def test_should_reset_token_when_gets_a_token_error(self, Manager):
+    async def test_should_only_refresh_for_401s_the_predicate_accepts(self, Manager):
+        manager = self._fake_manager(Manager, has_token=False)
+
+        class ClientTest(Client):
+            token_manager_class = Manager
+
+        client = ClientTest(token_endpoint=self.end_point,
+                            client_id='client_id',
+                            client_secret='client_secret',
+                            refresh_on_401=lambda response: False)
+
+        with patch('aioalf.client.Client._authorized_fetch') as _authorized_fetch:
+
+            _authorized_fetch.return_value = self._unauthorized()
+            response = await client.request('GET', self.resource_url)
+            self.assertEqual(response.status, 401)
+            self.assertEqual(_authorized_fetch.call_count, 1)
+            self.assertEqual(manager.reset_token.call_count, 0)
+
+    @unittest_run_loop
+    @patch('aioalf.client.TokenManager')
+    async def test_should_not_retry_when_the_token_was_not_refreshed(self, Manager):
+        manager = self._fake_manager(Manager, has_token=False)
+        manager.reset_token.return_value = False
+
+        with patch('aioalf.client.Client._authorized_fetch') as _authorized_fetch:
+
+            _authorized_fetch.return_value = self._unauthorized()
+            response = await self._request(Manager)
+            self.assertEqual(response.status, 401)
+            self.assertEqual(_authorized_fetch.call_count, 1)
+
+    @unittest_run_loop
+    @patch('aioalf.client.TokenManager')
+    async def test_should_release_the_401_response_before_refreshing(self, Manager):
+        manager = self._fake_manager(Manager, has_token=False)
+
+        with patch('aioalf.client.Client._authorized_fetch') as _authorized_fetch:
+
+            bad_response = self._unauthorized()
+            _authorized_fetch.side_effect = [bad_response, MagicMock(status=200)]
+
+            def reset_token(access_token):
+                bad_response.release.assert_called_once()
+                return True
+
+            manager.reset_token.side_effect = reset_token
+            response = await self._request(Manager)
+            self.assertEqual(response.status, 200)
+            manager.reset_token.assert_called_once()
+
+    @unittest_run_loop
+    @patch('aioalf.client.TokenManager')
+    async def test_should_read_a_401_that_already_arrived(self, Manager):
+        manager = self._fake_manager(Manager, has_token=False)
+        manager.reset_token.return_value = False
+
+        with patch('aioalf.client.Client._authorized_fetch') as _authorized_fetch:
+
+            bad_response = self._unauthorized()
+            bad_response.content.is_eof.return_value = True
+            bad_response.read = CoroutineMock(return_value=b'denied')
+            _authorized_fetch.return_value = bad_response
+            response = await self._request(Manager)
+            self.assertIs(response, bad_response)
+            bad_response.read.assert_called_once_with()
+            bad_response.release.assert_not_called()
+
+    @unittest_run_loop
+    @patch('aioalf.client.TokenManager')
+    async def test_should_not_reset_token_when_gets_a_token_error(self, Manager):
         manager = self._fake_manager(Manager, has_token=False)
 
         with patch('aioalf.client.Client._authorized_fetch') as _authorized_fetch:
@@ -102,10 +318,60 @@ class TestClient(AsyncTestCase):
                 else:
                     assert False, 'Should not have got this far'
                 self.assertEqual(_authorized_fetch.call_count, 1)
-                self.assertEqual(manager.reset_token.call_count, 1)
+                manager.reset_token.assert_not_called()
             else:
                 assert False, 'Should not have got this far'
 
+    @unittest_run_loop
+    @patch('aioalf.client.TokenManager')
+    async def test_should_not_mutate_caller_headers(self, Manager):
+        manager = self._fake_manager(Manager)
+        manager.get_token = CoroutineMock(return_value='token')
+        client = self._client(Manager)
+        client._http_client.request = CoroutineMock()
+        headers = {'Accept': 'text/plain', 'authorization': 'Basic old'}
+
+        await client.request('GET', self.resource_url, headers=headers)
+
+        self.assertEqual(headers, {'Accept': 'text/plain',
+                                   'authorization': 'Basic old'})
+        sent = client._http_client.request.call_args[1]['headers']
+        self.assertEqual(sent['Authorization'], 'Bearer token')
+        self.assertEqual(sent.getall('Authorization'), ['Bearer token'])
+        self.assertEqual(sent['Accept'], 'text/plain')
+        await client.close()
+
+    @unittest_run_loop
+    @patch('aioalf.client.TokenManager')
+    async def test_should_reuse_auth_headers_for_the_same_token(self, Manager):
+        manager = self._fake_manager(Manager)
+        manager.get_token = CoroutineMock(return_value='token')
+        client = self._client(Manager)
+        client._http_client.request = CoroutineMock()
+
+        await client.request('GET', self.resource_url)
+        await client.request('GET', self.resource_url)
+
+        first, second = [call[1]['headers'] for call
+                         in client._http_client.request.call_args_list]
+        self.assertIs(first, second)
+        self.assertEqual(dict(first), {'Authorization': 'Bearer token'})
+        await client.close()
+
+    def _unauthorized(self):
+        response = MagicMock(status=401, headers={})
+        response.content.is_eof.return_value = False
+        return response
+
+    def _client(self, manager):
+        class ClientTest(Client):
+            token_manager_class = manager
+
+        return ClientTest(
+            token_endpoint=self.end_point,
+            client_id='client_id',
+            client_secret='client_secret')
+
     async def _request(self, manager):
         class ClientTest(Client):
             token_manager_class = manager
@@ -128,6 +394,7 @@ class TestClient(AsyncTestCase):
         manager._has_token.return_value = has_token
         manager.get_token.return_value = CoroutineMock(access_token[0])
         manager.reset_token = CoroutineMock(return_value=None)
+        manager.close = CoroutineMock(return_value=None)
         manager.request_token.return_value = CoroutineMock(
             code=code,
             error=(code == 200 and None or Exception('error'))
@@ -136,3 +403,282 @@ class TestClient(AsyncTestCase):
         Manager.return_value = manager
 
         return manager
+
+
+class TestWWWAuthenticate(TestCase):
+
+    def test_should_parse_challenges(self):
+        challenges = parse_www_authenticate(
+            'Basic realm="api", Bearer realm="api", error="invalid_token", '
+            'error_description="The token \\"abc\\" expired"')
+
+        self.assertEqual(challenges, {
+            'basic': {'realm': 'api'},
+            'bearer': {
+                'realm': 'api',
+                'error': 'invalid_token',
+                'error_description': 'The token "abc" expired',
+            },
+        })
+
+    def test_should_accept_unquoted_params(self):
+        self.assertEqual(parse_www_authenticate('Bearer error=invalid_token'),
+                         {'bearer': {'error': 'invalid_token'}})
+
+    def test_should_only_reject_the_token_for_invalid_token_errors(self):
+        def response(header=None):
+            headers = {'WWW-Authenticate': header} if header else {}
+            return MagicMock(headers=headers)
+
+        self.assertTrue(is_token_rejected(response()))
+        self.assertTrue(is_token_rejected(response('Bearer realm="api"')))
+        self.assertTrue(is_token_rejected(
+            response('Bearer error="invalid_token"')))
+        self.assertTrue(is_token_rejected(response('Basic realm="api"')))
+        self.assertFalse(is_token_rejected(
+            response('Bearer error="insufficient_scope"')))
+        self.assertFalse(is_token_rejected(
+            response('Bearer error="invalid_request"')))
+
+
+class TestClientAgainstStubServer(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.server = await StubAuthServer(self.loop).start()
+        self.client = Client(token_endpoint=self.server.token_endpoint,
+                             client_id='client-id',
+                             client_secret='client_secret')
+
+    async def tearDownAsync(self):
+        await self.client.close()
+        await self.server.close()
+
+    async def _get(self):
+        response = await self.client.request('GET', self.server.resource_url)
+        await response.read()
+        return response.status
+
+    @unittest_run_loop
+    async def test_concurrent_401s_should_refresh_the_token_once(self):
+        self.assertEqual(await self._get(), 200)
+        self.assertEqual(self.server.token_fetches, 1)
+
+        self.server.valid_tokens = set()
+        statuses = await asyncio.gather(*[self._get() for _ in range(1000)])
+
+        self.assertEqual(self.server.token_fetches, 2)
+        self.assertEqual(set(statuses), {200})
+
+    @unittest_run_loop
+    async def test_concurrent_401s_should_refresh_a_reissued_token_once(self):
+        self.server.reissue_token = 'token'
+        self.assertEqual(await self._get(), 200)
+
+        self.server.valid_tokens = set()
+        # Every 401 comes back while the refresh is in flight.
+        self.server.token_delay = 0.5
+        statuses = await asyncio.gather(*[self._get() for _ in range(50)])
+
+        self.assertEqual(len(self.server.token_requests), 2)
+        self.assertEqual(set(statuses), {200})
+
+    @unittest_run_loop
+    async def test_401_after_a_refresh_should_refresh_again(self):
+        self.assertEqual(await self._get(), 200)
+        self.server.valid_tokens = set()
+        self.assertEqual(await self._get(), 200)
+        self.server.valid_tokens = set()
+        self.assertEqual(await self._get(), 200)
+
+        self.assertEqual(self.server.token_fetches, 3)
+
+    @unittest_run_loop
+    async def test_should_not_refresh_for_401s_about_something_else(self):
+        self.assertEqual(await self._get(), 200)
+        self.server.challenge = 'Bearer error="insufficient_scope"'
+
+        statuses = await asyncio.gather(*[self._get() for _ in range(10)])
+
+        self.assertEqual(set(statuses), {401})
+        self.assertEqual(self.server.token_fetches, 1)
+
+    @unittest_run_loop
+    async def test_should_rate_limit_refreshes_caused_by_401s(self):
+        await self.client.close()
+        manager_class = partial(TokenManager, min_reset_interval=60)
+        self.client = type('LimitedClient', (Client,), {
+            'token_manager_class': manager_class,
+        })(token_endpoint=self.server.token_endpoint,
+           client_id='client-id', client_secret='client_secret')
+        self.assertEqual(await self._get(), 200)
+        self.server.challenge = 'Bearer error="invalid_token"'
+
+        for _ in range(10):
+            self.assertEqual(await self._get(), 401)
+
+        self.assertEqual(self.server.token_fetches, 1)
+
+    @unittest_run_loop
+    async def test_should_free_the_connection_of_a_slow_401_before_refreshing(
+            self):
+        await self.client.close()
+        self.client = Client(token_endpoint=self.server.token_endpoint,
+                             client_id='client-id',
+                             client_secret='client_secret',
+                             connector_options={'limit': 1})
+        await self.client.request('GET', self.server.resource_url)
+        self.server.valid_tokens = set()
+
+        response = await asyncio.wait_for(
+            self.client.request('GET', self.server.slow_url), 1)
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.server.token_fetches, 2)
+
+    @unittest_run_loop
+    async def test_token_endpoint_outage_should_cost_one_request(self):
+        self.server.failures = 100
+
+        results = await asyncio.gather(*[self._get() for _ in range(50)],
+                                       return_exceptions=True)
+
+        self.assertTrue(all(isinstance(result, TokenHTTPError)
+                            for result in results))
+        self.assertEqual(self.server.failures, 99)
+
+    @unittest_run_loop
+    async def test_open_circuit_should_not_hide_the_fetch_error(self):
+        await self.client.close()
+        manager_class = partial(
+            TokenManager, circuit_breaker=CircuitBreaker(failure_threshold=1))
+        self.client = type('BreakerClient', (Client,), {
+            'token_manager_class': manager_class,
+        })(token_endpoint=self.server.token_endpoint,
+           client_id='client-id', client_secret='client_secret')
+        self.server.failures = 100
+
+        with self.assertRaises(TokenHTTPError):
+            await self._get()
+        self.assertEqual(self.server.failures, 99)
+
+    async def _upload(self, data, **kwargs):
+        response = await self.client.request('POST', self.server.upload_url,
+                                             data=data, **kwargs)
+        await response.read()
+        return response.status
+
+    @unittest_run_loop
+    async def test_should_replay_a_small_stream_after_a_401(self):
+        await self._get()
+        self.server.valid_tokens = set()
+
+        async def body():
+            yield b'small '
+            yield b'body'
+
+        self.assertEqual(await self._upload(body()), 200)
+        self.assertEqual(self.server.uploads, [b'small body'])
+        self.assertEqual(self.server.token_fetches, 2)
+
+    @unittest_run_loop
+    async def test_should_retry_a_large_stream_without_buffering_it(self):
+        await self._get()
+        self.server.valid_tokens = set()
+        consumed = []
+
+        async def body():
+            for n in range(64):
+                consumed.append(n)
+                yield b'x' * 1024
+
+        self.client._replay_buffer_size = 4096
+        self.assertEqual(await self._upload(body()), 200)
+        self.assertEqual(self.server.uploads, [b'x' * 64 * 1024])
+        self.assertEqual(consumed, list(range(64)))
+        self.assertEqual(self.server.token_fetches, 2)
+
+    @unittest_run_loop
+    async def test_should_rewind_a_file_after_a_401(self):
+        await self._get()
+        self.server.valid_tokens = set()
+
+        self.assertEqual(await self._upload(io.BytesIO(b'file body')), 200)
+        self.assertEqual(self.server.uploads, [b'file body'])
+
+    @unittest_run_loop
+    async def test_should_retry_a_large_file_after_a_401(self):
+        await self._get()
+        self.server.valid_tokens = set()
+
+        self.client._replay_buffer_size = 4
+        self.assertEqual(await self._upload(io.BytesIO(b'file body')), 200)
+        self.assertEqual(self.server.uploads, [b'file body'])
+
+    @unittest_run_loop
+    async def test_should_refresh_the_token_for_a_body_it_cannot_replay(self):
+        await self._get()
+        self.server.valid_tokens = set()
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b'pipe body')
+        os.close(write_fd)
+
+        with open(read_fd, 'rb') as pipe:
+            self.assertEqual(await self._upload(pipe), 401)
+
+        self.assertEqual(self.server.token_fetches, 2)
+        self.assertEqual(await self._upload(b'next body'), 200)
+        self.assertEqual(self.server.token_fetches, 2)
+
+    @unittest_run_loop
+    async def test_should_report_pool_stats(self):
+        stats = self.client.pool_stats()
+        self.assertEqual(stats['open'], 0)
+        self.assertEqual(stats['limit'], 100)
+
+        await self._get()
+        stats = self.client.pool_stats()
+        host = '%s:%s' % (self.server.server.host, self.server.server.port)
+        self.assertEqual(stats['acquired'], 0)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['open'], 1)
+        self.assertEqual(stats['hosts'][host], {'acquired': 0, 'idle': 1})
+
+    @unittest_run_loop
+    async def test_pool_stats_should_survive_other_connector_internals(self):
+        connector = MagicMock(spec=['limit', 'limit_per_host', '_conns'],
+                              limit=100, limit_per_host=0,
+                              _conns={('example.com', 80, False): []})
+        http_client = MagicMock(connector=connector)
+        with patch.object(self.client, '_http_client', http_client):
+            stats = self.client.pool_stats()
+
+        self.assertEqual(stats['limit'], 100)
+        self.assertIsNone(stats['open'])
+        self.assertEqual(stats['hosts'], {})
+
+    def test_host_name_should_accept_old_connection_keys(self):
+        self.assertEqual(_host_name(('example.com', 80, False)),
+                         'example.com:80')
+
+    @unittest_run_loop
+    async def test_request_many_should_share_one_token(self):
+        specs = [('GET', self.server.resource_url) for _ in range(100)]
+
+        results = [result async for result
+                   in self.client.request_many(specs, concurrency=10)]
+
+        self.assertEqual(len(results), 100)
+        self.assertEqual({r.response.status for r in results}, {200})
+        self.assertEqual(self.server.token_fetches, 1)
+
+    @unittest_run_loop
+    async def test_request_many_should_coalesce_401s(self):
+        await self._get()
+        self.server.valid_tokens = set()
+        specs = [('GET', self.server.resource_url) for _ in range(100)]
+
+        results = [result async for result
+                   in self.client.request_many(specs, concurrency=20)]
+
+        self.assertEqual({r.response.status for r in results}, {200})
+        self.assertEqual(self.server.token_fetches, 2)
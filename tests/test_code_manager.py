@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import hashlib
+from base64 import urlsafe_b64encode
+from urllib.parse import parse_qs, urlparse
+
+from aiohttp import ClientSession
+from asynctest import patch
+from . import AsyncTestCase, StubAuthServer
+from aiohttp.test_utils import unittest_run_loop
+from aioalf.code_manager import (OAuthAuthorizationCodeTokenManager,
+                                 make_pkce_pair)
+from aioalf.implicit_manager import CallbackServer
+
+
+class TestPKCE(AsyncTestCase):
+
+    def test_challenge_should_be_the_hashed_verifier(self):
+        verifier, challenge = make_pkce_pair()
+
+        digest = hashlib.sha256(verifier.encode('ascii')).digest()
+        self.assertEqual(
+            challenge, urlsafe_b64encode(digest).decode('ascii').rstrip('='))
+        self.assertTrue(43 <= len(verifier) <= 128)
+        self.assertNotEqual(make_pkce_pair()[0], verifier)
+
+
+class TestAuthorizationCodeTokenManager(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.server = await StubAuthServer(self.loop).start()
+        self.server.issue_refresh_tokens = True
+        self.callback_server = await CallbackServer(
+            port_range=None, host='127.0.0.1').start()
+        self.session = ClientSession()
+        self.logins = []
+
+    async def tearDownAsync(self):
+        await self.session.close()
+        await self.callback_server.stop()
+        await self.server.close()
+
+    def _manager(self, client_secret=''):
+        return OAuthAuthorizationCodeTokenManager(
+            self.server.token_endpoint, 'client_id', client_secret,
+            scope=['read', 'write'],
+            authorize_endpoint='https://auth.example.com/authorize',
+            callback_server=self.callback_server)
+
+    def _browser(self, url):
+        query = {key: values[0]
+                 for key, values in parse_qs(urlparse(url).query).items()}
+        self.logins.append(query)
+        asyncio.ensure_future(self.session.get(
+            query['redirect_uri'],
+            params={'code': 'code-%d' % len(self.logins),
+                    'state': query['state']}))
+
+    @patch('webbrowser.open')
+    @unittest_run_loop
+    async def test_should_exchange_the_code_with_pkce(self, browser_open):
+        browser_open.side_effect = self._browser
+        manager = self._manager()
+
+        self.assertEqual(await manager.get_token(), 'token-1')
+        await manager.close()
+
+        login = self.logins[0]
+        self.assertTrue(browser_open.call_args[0][0].startswith(
+            'https://auth.example.com/authorize?'))
+        self.assertEqual(login['response_type'], 'code')
+        self.assertEqual(login['code_challenge_method'], 'S256')
+        self.assertEqual(login['scope'], 'read write')
+
+        token_request = self.server.token_requests[0]
+        self.assertEqual(token_request['grant_type'], 'authorization_code')
+        self.assertEqual(token_request['code'], 'code-1')
+        self.assertEqual(token_request['client_id'], 'client_id')
+        self.assertEqual(token_request['redirect_uri'],
+                         self.callback_server.redirect_uri)
+        digest = hashlib.sha256(
+            token_request['code_verifier'].encode('ascii')).digest()
+        self.assertEqual(
+            urlsafe_b64encode(digest).decode('ascii').rstrip('='),
+            login['code_challenge'])
+
+    @patch('webbrowser.open')
+    @unittest_run_loop
+    async def test_should_renew_without_a_new_login(self, browser_open):
+        browser_open.side_effect = self._browser
+        manager = self._manager()
+
+        await manager.get_token()
+        await manager.reset_token('token-1')
+        self.assertEqual(await manager.get_token(), 'token-2')
+        await manager.close()
+
+        self.assertEqual(browser_open.call_count, 1)
+        self.assertEqual(self.server.token_requests[1]['grant_type'],
+                         'refresh_token')
+
+    @patch('webbrowser.open')
+    @unittest_run_loop
+    async def test_should_log_in_again_when_the_refresh_token_expires(
+            self, browser_open):
+        browser_open.side_effect = self._browser
+        manager = self._manager()
+
+        await manager.get_token()
+        self.server.refresh_tokens.clear()
+        await manager.reset_token('token-1')
+        await manager.close()
+
+        self.assertEqual(browser_open.call_count, 2)
+        self.assertEqual(self.server.token_requests[2]['code'], 'code-2')
+
+    def test_confidential_clients_should_authenticate(self):
+        self.assertNotIn('Authorization', self._manager()._token_headers())
+        self.assertEqual(
+            self._manager('secret')._token_headers()['Authorization'],
+            'Basic Y2xpZW50X2lkOnNlY3JldA==')
+
+    def test_should_default_the_authorize_endpoint(self):
+        manager = OAuthAuthorizationCodeTokenManager(
+            'https://auth.example.com/oauth/token', 'client_id', '')
+        self.assertEqual(manager._authorize_endpoint,
+                         'https://auth.example.com/oauth/authorize')
@@ -1,11 +1,20 @@
 # -*- coding: utf-8 -*-
 
-from unittest import TestCase
-from asyncio import Future
+import os
+import shutil
+import tempfile
+
+import asyncio
+from urllib.parse import parse_qs, urlparse
+
+from aiohttp import ClientSession
 from asynctest import patch, CoroutineMock, Mock
 from . import AsyncTestCase
 from aiohttp.test_utils import unittest_run_loop
-from aioalf.implicit_manager import OAuthImplictTokenManager, TokenStorage
+from aioalf.implicit_manager import (CallbackServer, OAuthImplictTokenManager,
+                                     TokenStorage)
+from aioalf.implicit_storage import FileTokenStorage, KeyringTokenStorage
+from aioalf.token import TokenError
 
 
 class TestImplicitTokenManager(AsyncTestCase):
@@ -20,47 +29,116 @@ class TestImplicitTokenManager(AsyncTestCase):
         self._fake_fetch = CoroutineMock()
         self.manager._fetch = self._fake_fetch
 
+    def _fake_callback_server(self):
+        server = Mock(redirect_uri='http://localhost:30000')
+        server.expect.return_value = 'xyz'
+        server.wait = CoroutineMock(return_value={'access_token': '1234'})
+        return server
+
     @unittest_run_loop
-    async def test_can_load_and_save_token_from_storage(self):
+    async def test_can_load_token_from_storage(self):
         storage = Mock()
-        storage.load.return_value = '1234'
+        storage.load = CoroutineMock(return_value='1234')
+        storage.save = CoroutineMock()
         self.manager.storage = storage
 
         token = await self.manager.get_token()
 
         self.assertEqual(token, '1234')
         storage.load.assert_called_once()
-        storage.save.assert_called_once()
+        storage.save.assert_not_called()
+
+    @unittest_run_loop
+    async def test_should_accept_synchronous_storages(self):
+        storage = Mock()
+        storage.load.return_value = '1234'
+        self.manager.storage = storage
+
+        token = await self.manager.get_token()
+
+        self.assertEqual(token, '1234')
 
     @unittest_run_loop
     async def test_can_reset_token_from_storage(self):
         storage = Mock()
+        storage.load = CoroutineMock(return_value='1234')
+        storage.clean = CoroutineMock()
         self.manager.storage = storage
 
-        self.manager.reset_token()
+        self.assertTrue(await self.manager.reset_token())
 
         storage.clean.assert_called_once()
 
+    @unittest_run_loop
+    async def test_reset_should_keep_a_token_stored_since_the_rejection(self):
+        self.manager.storage = TokenStorage()
+        await self.manager.storage.save('new')
+
+        await self.manager.reset_token('old')
+        self.assertEqual(await self.manager.storage.load(), 'new')
+
+        await self.manager.reset_token('new')
+        self.assertIsNone(await self.manager.storage.load())
+
     @patch('webbrowser.open')
     @unittest_run_loop
     async def test_can_open_browser(self, browser_open_mock):
         storage = Mock()
         storage.load.return_value = None
 
-        site = Mock()
-        site.stop = CoroutineMock()
-        token_waiter = Future()
-        token_waiter.set_result({'access_token': '1234'})
-        app = {'port': 30000, 'token_waiter': token_waiter}
-
         self.manager.storage = storage
-        self.manager.app = app
-        self.manager.site = site
+        self.manager.callback_server = self._fake_callback_server()
 
         token = await self.manager.get_token()
 
         self.assertEqual(token, '1234')
-        browser_open_mock.assert_called_with('http://endpoint/authorize?response_type=token&client_id=client_id&redirect_uri=http%3A//localhost%3A30000')  # noqa
+        storage.save.assert_called_once_with('1234')
+        browser_open_mock.assert_called_with('http://endpoint/authorize?response_type=token&client_id=client_id&redirect_uri=http%3A//localhost%3A30000&state=xyz')  # noqa
+
+    @patch('webbrowser.open')
+    @unittest_run_loop
+    async def test_should_log_in_again_when_the_token_expires(self, _):
+        now = [100.0]
+        self.manager = OAuthImplictTokenManager(self.end_point,
+                                                self.client_id,
+                                                self.client_secret,
+                                                clock=lambda: now[0])
+        self.manager.storage = TokenStorage()
+        server = self.manager.callback_server = self._fake_callback_server()
+        server.wait.side_effect = [
+            {'access_token': '1234', 'expires_in': '10'},
+            {'access_token': '5678', 'expires_in': '10'},
+        ]
+
+        self.assertEqual(await self.manager.get_token(), '1234')
+        now[0] = 109.0
+        self.assertEqual(await self.manager.get_token(), '1234')
+        now[0] = 110.0
+        self.assertEqual(await self.manager.get_token(), '5678')
+        self.assertEqual(await self.manager.storage.load(), '5678')
+
+    @patch('webbrowser.open')
+    @unittest_run_loop
+    async def test_should_forget_the_deadline_of_a_replaced_token(self, _):
+        now = [100.0]
+        self.manager = OAuthImplictTokenManager(self.end_point,
+                                                self.client_id,
+                                                self.client_secret,
+                                                clock=lambda: now[0])
+        self.manager.storage = TokenStorage()
+        server = self.manager.callback_server = self._fake_callback_server()
+        server.wait.side_effect = [
+            {'access_token': '1234', 'expires_in': '60'},
+            {'access_token': '5678'},
+        ]
+
+        self.assertEqual(await self.manager.get_token(), '1234')
+        await self.manager.reset_token('1234')
+        self.assertEqual(await self.manager.get_token(), '5678')
+
+        now[0] = 161.0
+        self.assertEqual(await self.manager.get_token(), '5678')
+        self.assertEqual(server.wait.call_count, 2)
 
     @patch('webbrowser.open')
     @unittest_run_loop
@@ -72,20 +150,13 @@ class TestImplicitTokenManager(AsyncTestCase):
         storage = Mock()
         storage.load.return_value = None
 
-        site = Mock()
-        site.stop = CoroutineMock()
-        token_waiter = Future()
-        token_waiter.set_result({'access_token': '1234'})
-        app = {'port': 30000, 'token_waiter': token_waiter}
-
         self.manager.storage = storage
-        self.manager.app = app
-        self.manager.site = site
+        self.manager.callback_server = self._fake_callback_server()
 
         token = await self.manager.get_token()
 
         self.assertEqual(token, '1234')
-        browser_open_mock.assert_called_with('http://endpoint/authorize?response_type=token&client_id=client_id&redirect_uri=http%3A//localhost%3A30000&scope=user')  # noqa
+        browser_open_mock.assert_called_with('http://endpoint/authorize?response_type=token&client_id=client_id&redirect_uri=http%3A//localhost%3A30000&scope=user&state=xyz')  # noqa
 
     @patch('webbrowser.open')
     @unittest_run_loop
@@ -97,43 +168,207 @@ class TestImplicitTokenManager(AsyncTestCase):
         storage = Mock()
         storage.load.return_value = None
 
-        site = Mock()
-        site.stop = CoroutineMock()
-        token_waiter = Future()
-        token_waiter.set_result({'access_token': '1234'})
-        app = {'port': 30000, 'token_waiter': token_waiter}
-
         self.manager.storage = storage
-        self.manager.app = app
-        self.manager.site = site
+        self.manager.callback_server = self._fake_callback_server()
 
         token = await self.manager.get_token()
 
         self.assertEqual(token, '1234')
-        browser_open_mock.assert_called_with('http://endpoint/authorize?response_type=token&client_id=client_id&redirect_uri=http%3A//localhost%3A30000&scope=user%20user%3Aadmin%20specialScope')  # noqa
+        browser_open_mock.assert_called_with('http://endpoint/authorize?response_type=token&client_id=client_id&redirect_uri=http%3A//localhost%3A30000&scope=user%20user%3Aadmin%20specialScope&state=xyz')  # noqa
+
+
+class TestCallbackServer(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.server = await CallbackServer(port_range=None,
+                                           host='127.0.0.1').start()
+        self.session = ClientSession()
+
+    async def tearDownAsync(self):
+        await self.session.close()
+        await self.server.stop()
+
+    async def _callback(self, **query):
+        async with self.session.get(self.server.redirect_uri,
+                                    params=query) as response:
+            return response.status
+
+    def _manager(self, client_id):
+        manager = OAuthImplictTokenManager('http://endpoint', client_id, '')
+        manager.storage = TokenStorage()
+        manager.callback_server = self.server
+        return manager
+
+    @patch('webbrowser.open')
+    @unittest_run_loop
+    async def test_should_route_concurrent_logins_by_state(self, browser_open):
+        states = {}
+
+        def remember_state(url):
+            query = parse_qs(urlparse(url).query)
+            states[query['client_id'][0]] = query['state'][0]
+
+        browser_open.side_effect = remember_state
+        logins = [asyncio.ensure_future(self._manager(name).get_token())
+                  for name in ('first', 'second')]
+        await asyncio.sleep(0.01)
 
+        self.assertEqual(self.server.pending, 2)
+        for name in ('second', 'first'):
+            status = await self._callback(access_token='token-%s' % name,
+                                          state=states[name])
+            self.assertEqual(status, 200)
 
-class TestTokenStorage(TestCase):
+        self.assertEqual(await asyncio.gather(*logins),
+                         ['token-first', 'token-second'])
+        self.assertEqual(self.server.pending, 0)
 
-    def test_can_save_token(self):
+    @patch('webbrowser.open')
+    @unittest_run_loop
+    async def test_should_serve_repeated_logins(self, browser_open):
+        manager = self._manager('client_id')
+
+        def login(url):
+            state = parse_qs(urlparse(url).query)['state'][0]
+            asyncio.ensure_future(
+                self._callback(access_token='token-%d' % browser_open.call_count,
+                               state=state))
+
+        browser_open.side_effect = login
+        self.assertEqual(await manager.get_token(), 'token-1')
+        await manager.reset_token('token-1')
+        self.assertEqual(await manager.get_token(), 'token-2')
+
+    @unittest_run_loop
+    async def test_should_serve_the_fragment_redirect_page(self):
+        async with self.session.get(self.server.redirect_uri) as response:
+            self.assertIn('window.location', await response.text())
+
+    @unittest_run_loop
+    async def test_should_reject_unknown_states(self):
+        self.assertEqual(await self._callback(access_token='x', state='nope'),
+                         400)
+
+    @unittest_run_loop
+    async def test_should_report_authorization_errors(self):
+        state = self.server.expect()
+        waiter = asyncio.ensure_future(self.server.wait(state))
+        await self._callback(error='access_denied', state=state)
+
+        with self.assertRaises(TokenError):
+            await waiter
+
+    @unittest_run_loop
+    async def test_should_fall_back_to_the_next_free_port(self):
+        taken = self.server.port
+        server = await CallbackServer(port_range=(taken, taken + 20),
+                                      host='127.0.0.1').start()
+        try:
+            self.assertNotEqual(server.port, taken)
+            self.assertTrue(taken < server.port <= taken + 20)
+        finally:
+            await server.stop()
+
+    @unittest_run_loop
+    async def test_should_fail_when_no_port_is_free(self):
+        taken = self.server.port
+        with self.assertRaises(TokenError):
+            await CallbackServer(port_range=(taken, taken),
+                                 host='127.0.0.1').start()
+
+
+class TestTokenStorage(AsyncTestCase):
+
+    @unittest_run_loop
+    async def test_can_save_token(self):
         storage = TokenStorage()
-        storage.save('1234')
+        await storage.save('1234')
 
         self.assertEqual(storage.token, '1234')
 
-    def test_can_load_token(self):
+    @unittest_run_loop
+    async def test_can_load_token(self):
         storage = TokenStorage()
         storage.token = '1234'
-        token = storage.load()
+        token = await storage.load()
 
         self.assertEqual(token, '1234')
 
-    def test_can_clean_token(self):
+    @unittest_run_loop
+    async def test_can_clean_token(self):
         storage = TokenStorage()
-        storage.save('1234')
+        await storage.save('1234')
 
         self.assertEqual(storage.token, '1234')
 
-        storage.clean()
+        await storage.clean()
 
         self.assertEqual(storage.token, None)
+
+
+class TestFileTokenStorage(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'auth', 'token')
+        self.storage = FileTokenStorage(self.path)
+
+    async def tearDownAsync(self):
+        shutil.rmtree(self.directory)
+
+    @unittest_run_loop
+    async def test_should_load_nothing_before_saving(self):
+        self.assertIsNone(await self.storage.load())
+
+    @unittest_run_loop
+    async def test_should_save_load_and_clean(self):
+        await self.storage.save('1234')
+        self.assertEqual(await FileTokenStorage(self.path).load(), '1234')
+
+        await self.storage.clean()
+        self.assertIsNone(await self.storage.load())
+        await self.storage.clean()
+
+    @unittest_run_loop
+    async def test_should_write_a_private_file_atomically(self):
+        await self.storage.save('1234')
+        await self.storage.save('5678')
+
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['token'])
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+
+class FakeKeyring(object):
+
+    def __init__(self):
+        self.passwords = {}
+
+    def get_password(self, service, username):
+        return self.passwords.get((service, username))
+
+    def set_password(self, service, username, password):
+        self.passwords[(service, username)] = password
+
+    def delete_password(self, service, username):
+        del self.passwords[(service, username)]
+
+
+class TestKeyringTokenStorage(AsyncTestCase):
+
+    @unittest_run_loop
+    async def test_should_keep_the_token_in_the_keyring(self):
+        backend = FakeKeyring()
+        storage = KeyringTokenStorage('client_id', backend=backend)
+
+        await storage.save('1234')
+        self.assertEqual(backend.passwords, {('aioalf', 'client_id'): '1234'})
+        self.assertEqual(await storage.load(), '1234')
+
+        await storage.clean()
+        await storage.clean()
+        self.assertIsNone(await storage.load())
+
+    @patch('aioalf.implicit_storage.keyring', None)
+    def test_should_require_keyring_or_a_backend(self):
+        with self.assertRaises(RuntimeError):
+            KeyringTokenStorage('client_id')
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from unittest import TestCase
+from . import AsyncTestCase, StubAuthServer
+from aiohttp.test_utils import unittest_run_loop
+from aioalf.client import Client
+from aioalf.instrumentation import Histogram, Instrumentation, MetricsCollector
+from aioalf.manager import TokenManager
+from aioalf.token import TokenError
+
+
+class TestInstrumentation(TestCase):
+
+    def test_should_call_every_callback_of_a_signal(self):
+        instrumentation = Instrumentation()
+        calls = []
+        instrumentation.on_token_fetch.append(
+            lambda **kwargs: calls.append(('a', kwargs)))
+        instrumentation.on_token_fetch.append(
+            lambda **kwargs: calls.append(('b', kwargs)))
+
+        instrumentation.on_token_fetch.send(duration=1, status=200)
+
+        self.assertEqual(calls, [('a', {'duration': 1, 'status': 200}),
+                                 ('b', {'duration': 1, 'status': 200})])
+
+    def test_signals_should_not_be_shared_between_instances(self):
+        first, second = Instrumentation(), Instrumentation()
+        first.on_request_end.append(print)
+        self.assertEqual(second.on_request_end, [])
+
+
+class TestMetricsCollector(TestCase):
+
+    def test_histogram_percentiles(self):
+        histogram = Histogram()
+        for value in range(1, 101):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.percentile(50), 50)
+        self.assertEqual(histogram.percentile(99), 99)
+        self.assertEqual(histogram.summary()['max'], 100)
+
+    def test_empty_histogram(self):
+        self.assertIsNone(Histogram().percentile(50))
+
+    def test_should_count_token_fetches_by_status(self):
+        instrumentation = Instrumentation()
+        metrics = MetricsCollector(instrumentation)
+
+        instrumentation.on_token_fetch.send(duration=0.1, status=200)
+        instrumentation.on_token_fetch.send(duration=0.2, status=503,
+                                            error=Exception())
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {
+            'token_fetches': 2,
+            'token_fetch_errors': 1,
+            'token_fetch_status.200': 1,
+            'token_fetch_status.503': 1,
+        })
+        self.assertEqual(
+            snapshot['histograms']['token_fetch_duration']['count'], 2)
+
+
+class TestInstrumentedClient(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.server = await StubAuthServer(self.loop).start()
+        self.instrumentation = Instrumentation()
+        self.metrics = MetricsCollector(self.instrumentation)
+        self.client = Client(token_endpoint=self.server.token_endpoint,
+                             client_id='client-id',
+                             client_secret='client_secret',
+                             instrumentation=self.instrumentation)
+
+    async def tearDownAsync(self):
+        await self.client.close()
+        await self.server.close()
+
+    async def _get(self):
+        response = await self.client.request('GET', self.server.resource_url)
+        await response.read()
+        return response.status
+
+    @unittest_run_loop
+    async def test_should_record_the_token_lifecycle(self):
+        await asyncio.gather(*[self._get() for _ in range(5)])
+        await self._get()
+
+        counters = self.metrics.counters
+        self.assertEqual(counters['requests'], 6)
+        self.assertEqual(counters['token_fetches'], 1)
+        self.assertEqual(counters['token_fetch_status.200'], 1)
+        self.assertEqual(counters['token_cache_misses'], 5)
+        self.assertEqual(counters['token_cache_hits'], 1)
+        self.assertEqual(self.metrics.histograms['token_lock_wait'].count, 5)
+        self.assertEqual(self.metrics.histograms['request_duration'].count,
+                         6)
+
+    @unittest_run_loop
+    async def test_should_record_401_retries(self):
+        await self._get()
+        self.server.valid_tokens = set()
+        await self._get()
+
+        self.assertEqual(self.metrics.counters['bad_token_retries'], 1)
+        self.assertEqual(self.metrics.counters['token_fetches'], 2)
+
+    @unittest_run_loop
+    async def test_should_record_failed_token_fetches(self):
+        self.server.failures = 1
+        with self.assertRaises(TokenError):
+            await self._get()
+
+        counters = self.metrics.counters
+        self.assertEqual(counters['token_fetch_errors'], 1)
+        self.assertEqual(counters['token_fetch_status.503'], 1)
+        self.assertEqual(counters['request_errors'], 1)
+
+
+class TestInstrumentedManager(AsyncTestCase):
+
+    @unittest_run_loop
+    async def test_should_record_stale_tokens(self):
+        server = await StubAuthServer(self.loop, expires_in=0).start()
+        instrumentation = Instrumentation()
+        metrics = MetricsCollector(instrumentation)
+        manager = TokenManager(server.token_endpoint, 'client-id', 'secret',
+                               stale_grace=60, stale_retry_interval=60,
+                               instrumentation=instrumentation)
+        try:
+            await manager.get_token()
+            server.failures = 1
+            await manager.get_token()
+        finally:
+            await manager.close()
+            await server.close()
+
+        self.assertEqual(metrics.counters['stale_tokens_served'], 1)
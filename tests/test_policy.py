@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from unittest import TestCase
+from asynctest import CoroutineMock, patch
+from aiohttp import ClientConnectionError
+from . import AsyncTestCase, StubAuthServer
+from aiohttp.test_utils import unittest_run_loop
+from aioalf.manager import TokenManager
+from aioalf.policy import RetryPolicy, CircuitBreaker
+from aioalf.token import Token, TokenError, TokenHTTPError
+
+
+class TestRetryPolicy(AsyncTestCase):
+
+    def test_delay_should_grow_exponentially_up_to_the_limit(self):
+        policy = RetryPolicy(backoff=0.1, max_backoff=0.5, jitter=0)
+
+        self.assertEqual([policy.delay(n) for n in range(4)],
+                         [0.1, 0.2, 0.4, 0.5])
+
+    def test_delay_should_apply_jitter(self):
+        policy = RetryPolicy(backoff=1, jitter=0.5)
+
+        for _ in range(100):
+            self.assertTrue(0.5 <= policy.delay(0) <= 1.5)
+
+    def test_should_only_retry_transient_errors(self):
+        policy = RetryPolicy()
+
+        self.assertTrue(policy.is_retryable(TokenHTTPError('e', 503)))
+        self.assertTrue(policy.is_retryable(ClientConnectionError()))
+        self.assertTrue(policy.is_retryable(asyncio.TimeoutError()))
+        self.assertFalse(policy.is_retryable(TokenHTTPError('e', 401)))
+        self.assertFalse(policy.is_retryable(TokenError('e')))
+
+    @unittest_run_loop
+    @patch('aioalf.policy.asyncio.sleep', new_callable=CoroutineMock)
+    async def test_should_retry_until_success(self, sleep):
+        function = CoroutineMock(side_effect=[
+            TokenHTTPError('e', 503), TokenHTTPError('e', 502), 'result'])
+        policy = RetryPolicy(retries=2)
+
+        self.assertEqual(await policy.call(function), 'result')
+        self.assertEqual(function.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    @unittest_run_loop
+    @patch('aioalf.policy.asyncio.sleep', new_callable=CoroutineMock)
+    async def test_should_give_up_after_the_retries(self, sleep):
+        function = CoroutineMock(side_effect=TokenHTTPError('e', 503))
+        policy = RetryPolicy(retries=2)
+
+        with self.assertRaises(TokenHTTPError):
+            await policy.call(function)
+        self.assertEqual(function.call_count, 3)
+
+    @unittest_run_loop
+    async def test_should_wrap_connection_errors(self):
+        function = CoroutineMock(side_effect=ClientConnectionError('down'))
+
+        with self.assertRaises(TokenError):
+            await RetryPolicy().call(function)
+
+    @unittest_run_loop
+    async def test_should_not_retry_permanent_errors(self):
+        function = CoroutineMock(side_effect=TokenHTTPError('e', 401))
+
+        with self.assertRaises(TokenHTTPError):
+            await RetryPolicy(retries=3).call(function)
+        self.assertEqual(function.call_count, 1)
+
+    @unittest_run_loop
+    async def test_should_enforce_the_total_timeout(self):
+        async def slow():
+            await asyncio.sleep(1)
+
+        with self.assertRaises(TokenError):
+            await RetryPolicy(timeout=0.01).call(slow)
+
+
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10,
+                                      clock=lambda: self.now[0])
+
+    def test_should_open_after_the_failure_threshold(self):
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_should_half_open_after_the_reset_timeout(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+        self.now[0] = 10
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+
+    def test_should_reopen_when_the_trial_fails(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now[0] = 10
+
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+
+    def test_should_close_on_success(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now[0] = 10
+
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+
+
+class TestTokenManagerWithFlakyServer(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.server = await StubAuthServer(self.loop).start()
+
+    async def tearDownAsync(self):
+        await self.manager.close()
+        await self.server.close()
+
+    def _manager(self, **kwargs):
+        self.manager = TokenManager(self.server.token_endpoint,
+                                    'client_id', 'client_secret', **kwargs)
+        return self.manager
+
+    @unittest_run_loop
+    async def test_should_retry_failed_token_requests(self):
+        self.server.failures = 2
+        manager = self._manager(retry_policy=RetryPolicy(retries=2,
+                                                         backoff=0.01))
+
+        self.assertEqual(await manager.get_token(), 'token-1')
+
+    @unittest_run_loop
+    async def test_should_raise_http_error_when_retries_run_out(self):
+        self.server.failures = 3
+        manager = self._manager(retry_policy=RetryPolicy(retries=1,
+                                                         backoff=0.01))
+
+        with self.assertRaises(TokenHTTPError) as context:
+            await manager.get_token()
+        self.assertEqual(context.exception.response_status, 503)
+
+    @unittest_run_loop
+    async def test_should_time_out_a_slow_token_endpoint(self):
+        self.server.token_delay = 0.5
+        manager = self._manager(retry_policy=RetryPolicy(timeout=0.05))
+
+        with self.assertRaises(TokenError):
+            await manager.get_token()
+
+    @unittest_run_loop
+    async def test_open_circuit_should_keep_serving_valid_token(self):
+        manager = self._manager(
+            circuit_breaker=CircuitBreaker(failure_threshold=1))
+        self.assertEqual(await manager.get_token(), 'token-1')
+
+        self.server.failures = 10
+        with self.assertRaises(TokenHTTPError):
+            await manager.reset_token()
+
+        await manager.reset_token()
+        self.assertEqual(await manager.get_token(), 'token-1')
+        self.assertEqual(self.server.failures, 9)
+
+    @unittest_run_loop
+    async def test_open_circuit_should_fail_fast_without_a_token(self):
+        manager = self._manager(
+            circuit_breaker=CircuitBreaker(failure_threshold=1))
+        manager._token = Token('expired', expires_in=0)
+        self.server.failures = 10
+
+        with self.assertRaises(TokenHTTPError):
+            await manager.get_token()
+        with self.assertRaises(TokenError):
+            await manager.get_token()
+        self.assertEqual(self.server.failures, 9)
+
+    @unittest_run_loop
+    async def test_concurrent_callers_should_share_a_failed_fetch(self):
+        self.server.failures = 100
+        self.server.token_delay = 0.01
+        manager = self._manager(retry_policy=RetryPolicy(retries=2,
+                                                         backoff=0.01))
+
+        results = await asyncio.gather(
+            *[manager.get_token() for _ in range(20)],
+            return_exceptions=True)
+
+        self.assertTrue(all(isinstance(result, TokenHTTPError)
+                            for result in results))
+        self.assertEqual(self.server.failures, 97)
+
+    @unittest_run_loop
+    async def test_queued_callers_should_not_outlast_the_timeout(self):
+        self.server.token_delay = 0.5
+        manager = self._manager(retry_policy=RetryPolicy(timeout=0.05))
+
+        started = self.loop.time()
+        results = await asyncio.gather(
+            *[manager.get_token() for _ in range(10)],
+            return_exceptions=True)
+
+        self.assertTrue(all(isinstance(result, TokenError)
+                            for result in results))
+        self.assertLess(self.loop.time() - started, 0.3)
+
+    @unittest_run_loop
+    async def test_a_later_caller_should_try_again(self):
+        self.server.failures = 1
+        manager = self._manager()
+
+        with self.assertRaises(TokenHTTPError):
+            await manager.get_token()
+        self.assertEqual(await manager.get_token(), 'token-1')
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+from email.utils import formatdate
+
+from asynctest import Mock, patch
+from . import AsyncTestCase, StubAuthServer
+from aiohttp.test_utils import unittest_run_loop
+from aioalf.client import Client
+from aioalf.instrumentation import Instrumentation, MetricsCollector
+from aioalf.ratelimit import RateLimiter, by_host, retry_after
+
+_yield = asyncio.sleep
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, delay):
+        # Concurrent sleepers overlap, as they would on a real clock.
+        self.sleeps.append(delay)
+        wake_at = self.now + delay
+        await _yield(0)
+        self.now = max(self.now, wake_at)
+
+
+def make_response(status, retry_after=None):
+    headers = {}
+    if retry_after is not None:
+        headers['Retry-After'] = retry_after
+    return Mock(status=status, headers=headers)
+
+
+class TestRetryAfter(AsyncTestCase):
+
+    def test_should_parse_seconds(self):
+        self.assertEqual(retry_after(make_response(429, '120')), 120)
+        self.assertEqual(retry_after(make_response(429, '-1')), 0)
+
+    def test_should_parse_http_dates(self):
+        now = time.time()
+        header = formatdate(now + 30, usegmt=True)
+        self.assertAlmostEqual(retry_after(make_response(503, header), now),
+                               30, delta=1)
+
+    def test_should_ignore_missing_or_invalid_values(self):
+        self.assertIsNone(retry_after(make_response(429)))
+        self.assertIsNone(retry_after(make_response(429, 'soon')))
+
+    def test_by_host_should_key_on_host_and_port(self):
+        self.assertEqual(by_host('GET', 'http://example.com:8080/a?b=c'),
+                         'example.com:8080')
+
+
+class TestRateLimiter(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.clock = FakeClock()
+        self.patcher = patch('aioalf.ratelimit.asyncio.sleep',
+                             self.clock.sleep)
+        self.patcher.start()
+
+    async def tearDownAsync(self):
+        self.patcher.stop()
+
+    async def _send(self, limiter, url, sent):
+        limit = limiter.limit('GET', url)
+        await limit.acquire()
+        sent.append(self.clock.now)
+        limit.release()
+
+    @unittest_run_loop
+    async def test_should_let_a_burst_through_then_pace_requests(self):
+        limiter = RateLimiter(rate=10, burst=3, clock=self.clock)
+        sent = []
+
+        await asyncio.gather(*[self._send(limiter, 'http://a/', sent)
+                               for _ in range(6)])
+
+        self.assertEqual(sent[:3], [100.0] * 3)
+        self.assertEqual([round(when - 100, 3) for when in sent[3:]],
+                         [0.1, 0.2, 0.3])
+
+    @unittest_run_loop
+    async def test_should_keep_a_bucket_per_host(self):
+        limiter = RateLimiter(rate=1, clock=self.clock)
+        sent = []
+
+        await asyncio.gather(self._send(limiter, 'http://a/', sent),
+                             self._send(limiter, 'http://b/', sent))
+
+        self.assertEqual(sent, [100.0, 100.0])
+        self.assertEqual(set(limiter.stats()), {'a', 'b'})
+
+    @unittest_run_loop
+    async def test_should_limit_concurrency(self):
+        limiter = RateLimiter(concurrency=2, clock=self.clock)
+        limits = [limiter.limit('GET', 'http://a/') for _ in range(3)]
+        await limits[0].acquire()
+        await limits[1].acquire()
+
+        third = asyncio.ensure_future(limits[2].acquire())
+        await _yield(0)
+        self.assertFalse(third.done())
+        self.assertEqual(limiter.queue_depth, 1)
+        self.assertEqual(limiter.stats()['a']['in_flight'], 2)
+
+        limits[0].release()
+        await third
+        self.assertEqual(limiter.queue_depth, 0)
+
+    @unittest_run_loop
+    async def test_should_pause_the_host_on_retry_after(self):
+        instrumentation = Instrumentation()
+        metrics = MetricsCollector(instrumentation)
+        limiter = RateLimiter(rate=10, burst=5, clock=self.clock,
+                              instrumentation=instrumentation)
+        limit = limiter.limit('GET', 'http://a/')
+
+        limiter.observe(limit, make_response(429, '2'))
+        self.assertEqual(limiter.stats()['a']['blocked_for'], 2)
+
+        sent = []
+        await asyncio.gather(*[self._send(limiter, 'http://a/', sent)
+                               for _ in range(2)])
+
+        self.assertEqual([round(when - 100, 3) for when in sent], [2.1, 2.2])
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {'rate_limited': 1})
+        self.assertEqual(snapshot['histograms']['rate_limit_wait']['count'], 2)
+
+    @unittest_run_loop
+    async def test_should_cap_retry_after(self):
+        limiter = RateLimiter(max_retry_after=5, clock=self.clock)
+        limit = limiter.limit('GET', 'http://a/')
+
+        limiter.observe(limit, make_response(503, '3600'))
+        self.assertEqual(limit.blocked_for, 5)
+
+        limiter.observe(limit, make_response(500, '10'))
+        self.assertEqual(limit.blocked_for, 5)
+
+    @unittest_run_loop
+    async def test_cancelled_waiters_should_give_their_token_back(self):
+        limiter = RateLimiter(rate=1, clock=self.clock)
+        first, second = (limiter.limit('GET', 'http://a/') for _ in range(2))
+        await first.acquire()
+
+        self.clock.sleep = Mock(side_effect=asyncio.CancelledError)
+        with patch('aioalf.ratelimit.asyncio.sleep', self.clock.sleep):
+            with self.assertRaises(asyncio.CancelledError):
+                await second.acquire()
+
+        self.assertEqual(second.waiting, 0)
+        self.assertEqual(second._tokens, 0)
+
+
+class TestClientRateLimit(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.server = await StubAuthServer(self.loop).start()
+        self.limiter = RateLimiter(concurrency=4, max_retry_after=0.05)
+        self.client = Client(token_endpoint=self.server.token_endpoint,
+                             client_id='client_id',
+                             client_secret='client_secret',
+                             rate_limiter=self.limiter)
+
+    async def tearDownAsync(self):
+        await self.client.close()
+        await self.server.close()
+
+    @unittest_run_loop
+    async def test_should_wait_out_retry_after_before_the_next_request(self):
+        self.server.throttle = '1'
+        response = await self.client.request('GET', self.server.resource_url)
+        self.assertEqual(response.status, 429)
+
+        started = time.monotonic()
+        response = await self.client.request('GET', self.server.resource_url)
+        self.assertEqual(response.status, 200)
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+
+        stats = list(self.limiter.stats().values())
+        self.assertEqual(stats, [{'waiting': 0, 'in_flight': 0,
+                                  'blocked_for': 0}])
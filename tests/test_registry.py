@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+from asynctest import CoroutineMock, Mock, patch
+from . import AsyncTestCase
+from aiohttp.test_utils import unittest_run_loop
+from aioalf.registry import TokenManagerRegistry
+from aioalf.registry import logger as registry_logger
+
+
+class TestTokenManagerRegistry(AsyncTestCase):
+
+    end_point = 'http://endpoint/token'
+
+    async def setUpAsync(self):
+        self.registry = TokenManagerRegistry()
+        self.Manager = Mock(side_effect=self._make_manager)
+
+    def _make_manager(self, **kwargs):
+        manager = Mock(**kwargs)
+        manager.close = CoroutineMock()
+        return manager
+
+    def _acquire(self, client_id='client_id', scope=None,
+                 client_secret='client_secret'):
+        return self.registry.acquire(self.Manager,
+                                     token_endpoint=self.end_point,
+                                     client_id=client_id,
+                                     client_secret=client_secret,
+                                     scope=scope)
+
+    def test_should_share_a_manager_for_the_same_credentials(self):
+        first = self._acquire()
+        second = self._acquire()
+
+        self.assertIs(first, second)
+        self.assertEqual(self.Manager.call_count, 1)
+        self.assertEqual(len(self.registry), 1)
+
+    def test_should_not_share_managers_across_client_ids(self):
+        first = self._acquire('client_a')
+        second = self._acquire('client_b')
+
+        self.assertIsNot(first, second)
+        self.assertEqual(len(self.registry), 2)
+
+    def test_should_not_share_managers_across_scopes(self):
+        first = self._acquire(scope='user')
+        second = self._acquire(scope='admin')
+
+        self.assertIsNot(first, second)
+
+    def test_should_ignore_scope_order(self):
+        first = self._acquire(scope=['user', 'admin'])
+        second = self._acquire(scope=['admin', 'user'])
+
+        self.assertIs(first, second)
+
+    def test_should_normalize_scopes_like_the_token_manager(self):
+        first = self._acquire(scope='b a')
+        second = self._acquire(scope=['a', 'b'])
+
+        self.assertIs(first, second)
+
+    def test_should_not_share_managers_across_secrets(self):
+        first = self._acquire()
+        second = self._acquire(client_secret='WRONG')
+
+        self.assertIsNot(first, second)
+        self.assertEqual(second.client_secret, 'WRONG')
+
+    def test_should_warn_when_a_later_client_has_other_options(self):
+        first = self._acquire()
+        with self.assertLogs('aioalf.registry', 'WARNING') as logs:
+            second = self.registry.acquire(self.Manager,
+                                           token_endpoint=self.end_point,
+                                           client_id='client_id',
+                                           client_secret='client_secret',
+                                           http_options={'timeout': 5},
+                                           instrumentation=object())
+
+        self.assertIs(first, second)
+        self.assertIn('http_options, instrumentation', logs.output[0])
+
+    def test_should_not_warn_for_the_same_options(self):
+        with patch.object(registry_logger, 'warning') as warning:
+            self._acquire()
+            self.registry.acquire(self.Manager,
+                                  token_endpoint=self.end_point,
+                                  client_id='client_id',
+                                  client_secret='client_secret',
+                                  http_options={})
+
+        warning.assert_not_called()
+
+    @unittest_run_loop
+    async def test_should_evict_manager_when_last_reference_is_released(self):
+        manager = self._acquire()
+        self._acquire()
+
+        await self.registry.release(manager)
+        self.assertEqual(len(self.registry), 1)
+        manager.close.assert_not_called()
+
+        await self.registry.release(manager)
+        self.assertEqual(len(self.registry), 0)
+        manager.close.assert_called_once()
+
+        self.assertIsNot(self._acquire(), manager)
+
+    @unittest_run_loop
+    async def test_should_ignore_unknown_managers(self):
+        manager = self._make_manager()
+
+        await self.registry.release(manager)
+
+        manager.close.assert_not_called()
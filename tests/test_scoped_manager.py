@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from asynctest import CoroutineMock
+from . import AsyncTestCase, StubAuthServer
+from aiohttp.test_utils import unittest_run_loop
+from aioalf.client import Client
+from aioalf.manager import TokenManager
+from aioalf.scoped_manager import MultiScopeTokenManager
+
+
+class TestMultiScopeTokenManager(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.manager = MultiScopeTokenManager('http://endpoint/token',
+                                              'client_id', 'client_secret',
+                                              max_scopes=2)
+
+    async def tearDownAsync(self):
+        await self.manager.close()
+
+    @unittest_run_loop
+    async def test_should_reuse_the_manager_of_an_equivalent_scope(self):
+        manager = self.manager.for_scope('read write')
+        self.assertIs(self.manager.for_scope(['write', 'read']), manager)
+        self.assertEqual(manager._scope, 'read write')
+
+    @unittest_run_loop
+    async def test_scopes_should_share_one_session(self):
+        read = self.manager.for_scope('read')
+        write = self.manager.for_scope('write')
+
+        self.assertIsNot(read, write)
+        self.assertIs(read._session, write._session)
+        self.assertFalse(read._owns_session)
+
+    @unittest_run_loop
+    async def test_should_evict_the_least_recently_used_scope(self):
+        read = self.manager.for_scope('read')
+        write = self.manager.for_scope('write')
+        read.close = CoroutineMock()
+        write.close = CoroutineMock()
+
+        self.manager.for_scope('read')
+        self.manager.for_scope('admin')
+        await asyncio.sleep(0)
+
+        self.assertEqual(self.manager.scopes, [('read',), ('admin',)])
+        write.close.assert_called_once_with()
+        read.close.assert_not_called()
+
+    @unittest_run_loop
+    async def test_should_pass_options_to_scope_managers(self):
+        manager = MultiScopeTokenManager('http://endpoint/token',
+                                         'client_id', 'client_secret',
+                                         refresh_ratio=0.5)
+        self.assertEqual(manager.for_scope('read')._refresh_ratio, 0.5)
+        await manager.close()
+
+
+class TestTokenManagerScope(AsyncTestCase):
+
+    def test_should_only_handle_its_own_scope(self):
+        manager = TokenManager('http://endpoint/token', 'client_id',
+                               'client_secret', scope=['read', 'write'])
+
+        self.assertIs(manager.for_scope('write read'), manager)
+        with self.assertRaises(ValueError):
+            manager.for_scope('admin')
+
+
+class TestMultiScopeClient(AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.server = await StubAuthServer(self.loop).start()
+
+        class ScopedClient(Client):
+            token_manager_class = MultiScopeTokenManager
+
+        self.client = ScopedClient(token_endpoint=self.server.token_endpoint,
+                                   client_id='client-id',
+                                   client_secret='client_secret')
+
+    async def tearDownAsync(self):
+        await self.client.close()
+        await self.server.close()
+
+    async def _get(self, scope=None):
+        response = await self.client.request('GET', self.server.resource_url,
+                                             scope=scope)
+        await response.read()
+        return response.request_info.headers['Authorization']
+
+    @unittest_run_loop
+    async def test_should_fetch_one_token_per_scope(self):
+        results = await asyncio.gather(
+            *[self._get(scope) for scope in ['read', 'write'] * 50])
+
+        self.assertEqual(self.server.token_fetches, 2)
+        self.assertEqual(sorted(self.server.token_scopes), ['read', 'write'])
+        self.assertEqual(len(set(results)), 2)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import shutil
+import tempfile
+
+from asynctest import CoroutineMock
+from . import AsyncTestCase
+from aiohttp.test_utils import unittest_run_loop
+from aioalf.manager import TokenHTTPError, TokenManager
+from aioalf.storage import (FileTokenStore, KeyValueTokenStore,
+                            MemoryKeyValueBackend)
+
+
+class StoreTestsMixin(object):
+
+    @unittest_run_loop
+    async def test_should_load_nothing_for_unknown_key(self):
+        self.assertIsNone(await self.store.load('unknown'))
+
+    @unittest_run_loop
+    async def test_should_save_and_load_token(self):
+        await self.store.save('key', {'access_token': 'token',
+                                      'expires_in': 10})
+
+        token_data = await self.store.load('key')
+
+        self.assertEqual(token_data['access_token'], 'token')
+        self.assertTrue(9 < token_data['expires_in'] <= 10)
+
+    @unittest_run_loop
+    async def test_lock_should_be_exclusive(self):
+        events = []
+
+        async def hold(name):
+            async with self.store.lock('key'):
+                events.append('enter %s' % name)
+                await asyncio.sleep(0.05)
+                events.append('exit %s' % name)
+
+        await asyncio.gather(hold('a'), hold('b'))
+
+        self.assertEqual([e.split()[0] for e in events],
+                         ['enter', 'exit', 'enter', 'exit'])
+
+    @unittest_run_loop
+    async def test_managers_sharing_a_store_should_fetch_once(self):
+        fetch = CoroutineMock(return_value={'access_token': 'token',
+                                            'expires_in': 10})
+        managers = []
+        for _ in range(5):
+            manager = TokenManager('http://endpoint/token', 'client_id',
+                                   'client_secret', store=self.store)
+            manager._fetch = fetch
+            managers.append(manager)
+
+        tokens = await asyncio.gather(*[m.get_token() for m in managers])
+
+        self.assertEqual(tokens, ['token'] * 5)
+        self.assertEqual(fetch.call_count, 1)
+
+    @unittest_run_loop
+    async def test_reset_should_not_reuse_the_rejected_token(self):
+        fetch = CoroutineMock(side_effect=[
+            {'access_token': 'first', 'expires_in': 10},
+            {'access_token': 'second', 'expires_in': 10},
+        ])
+        manager = TokenManager('http://endpoint/token', 'client_id',
+                               'client_secret', store=self.store)
+        manager._fetch = fetch
+        other = TokenManager('http://endpoint/token', 'client_id',
+                             'client_secret', store=self.store)
+        other._fetch = fetch
+
+        self.assertEqual(await manager.get_token(), 'first')
+        await manager.reset_token()
+        self.assertEqual(await manager.get_token(), 'second')
+        self.assertEqual(await other.get_token(), 'second')
+        self.assertEqual(fetch.call_count, 2)
+
+    @unittest_run_loop
+    async def test_should_not_share_a_token_across_secrets(self):
+        fetch = CoroutineMock(return_value={'access_token': 'token',
+                                            'expires_in': 10})
+        manager = TokenManager('http://endpoint/token', 'client_id',
+                               'client_secret', store=self.store)
+        manager._fetch = fetch
+        other = TokenManager('http://endpoint/token', 'client_id',
+                             'WRONG', store=self.store)
+        other._fetch = CoroutineMock(
+            side_effect=TokenHTTPError('Unauthorized', 401))
+
+        await manager.get_token()
+        with self.assertRaises(TokenHTTPError):
+            await other.get_token()
+
+
+class TestFileTokenStore(StoreTestsMixin, AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = FileTokenStore(self.directory)
+
+    async def tearDownAsync(self):
+        shutil.rmtree(self.directory)
+
+    @unittest_run_loop
+    async def test_should_ignore_corrupted_files(self):
+        with open(self.store._path('key', '.json'), 'w') as token_file:
+            token_file.write('{not json')
+
+        self.assertIsNone(await self.store.load('key'))
+
+    @unittest_run_loop
+    async def test_should_not_leave_temporary_files(self):
+        await self.store.save('key', {'access_token': 'token',
+                                      'expires_in': 10})
+
+        self.assertEqual(os.listdir(self.directory),
+                         [os.path.basename(self.store._path('key', '.json'))])
+
+    def test_should_refuse_a_directory_others_can_write_to(self):
+        os.chmod(self.directory, 0o777)
+
+        with self.assertRaises(RuntimeError):
+            FileTokenStore(self.directory)
+
+    def test_should_default_to_a_private_directory_per_user(self):
+        store = FileTokenStore()
+
+        self.assertTrue(store._directory.endswith('-%d' % os.getuid()))
+        self.assertEqual(os.stat(store._directory).st_mode & 0o777, 0o700)
+
+
+class TestKeyValueTokenStore(StoreTestsMixin, AsyncTestCase):
+
+    async def setUpAsync(self):
+        self.backend = MemoryKeyValueBackend()
+        self.store = KeyValueTokenStore(self.backend,
+                                        lock_poll_interval=0.01)
+
+    @unittest_run_loop
+    async def test_should_expire_token_with_its_lifetime(self):
+        await self.store.save('key', {'access_token': 'token',
+                                      'expires_in': 10})
+
+        _, expires_at = self.backend._data[self.store._key('key', 'token')]
+        self.assertIsNotNone(expires_at)
+
+    @unittest_run_loop
+    async def test_should_not_release_a_lock_taken_over_by_another_owner(self):
+        store = KeyValueTokenStore(self.backend, lock_ttl=0.01,
+                                   lock_poll_interval=0.01)
+        lock_key = store._key('key', 'lock')
+
+        async with store.lock('key'):
+            await asyncio.sleep(0.02)
+            self.assertTrue(await self.backend.add(lock_key, 'other'))
+
+        self.assertEqual(await self.backend.get(lock_key), 'other')
+
+
+class TestMemoryKeyValueBackend(AsyncTestCase):
+
+    @unittest_run_loop
+    async def test_add_should_only_set_missing_keys(self):
+        backend = MemoryKeyValueBackend()
+
+        self.assertTrue(await backend.add('key', 'a'))
+        self.assertFalse(await backend.add('key', 'b'))
+        self.assertEqual(await backend.get('key'), 'a')
+
+        await backend.delete('key')
+        self.assertIsNone(await backend.get('key'))
+
+    @unittest_run_loop
+    async def test_delete_if_should_only_delete_a_matching_value(self):
+        backend = MemoryKeyValueBackend()
+        await backend.set('key', 'a')
+
+        await backend.delete_if('key', 'b')
+        self.assertEqual(await backend.get('key'), 'a')
+
+        await backend.delete_if('key', 'a')
+        self.assertIsNone(await backend.get('key'))
+
+    @unittest_run_loop
+    async def test_should_expire_keys(self):
+        backend = MemoryKeyValueBackend()
+        await backend.set('key', 'value', ttl=0.01)
+
+        await asyncio.sleep(0.02)
+
+        self.assertIsNone(await backend.get('key'))
+        self.assertTrue(await backend.add('key', 'value'))
@@ -2,9 +2,22 @@
 # encoding: utf-8
 
 import datetime
+import json
+import logging
+from base64 import urlsafe_b64encode
 
-from unittest import TestCase
-from aioalf.token import Token, TokenHTTPError
+from unittest import TestCase, mock
+from aioalf.token import (Token, TokenHTTPError, TOKEN_FILTER,
+                          mask_authorization, log_request,
+                          decode_jwt_claims, jwt_expires_in)
+
+
+def make_jwt(claims):
+    def encode(value):
+        encoded = urlsafe_b64encode(json.dumps(value).encode('utf-8'))
+        return encoded.decode('ascii').rstrip('=')
+
+    return '%s.%s.signature' % (encode({'alg': 'RS256'}), encode(claims))
 
 
 class TestToken(TestCase):
@@ -27,6 +40,96 @@ class TestToken(TestCase):
         self.assertTrue(
             token.expires_on < datetime.datetime.utcnow() + datetime.timedelta(seconds=15))
 
+    def test_should_expire_with_the_clock(self):
+        now = [100.0]
+        token = Token('access_token', expires_in=10, clock=lambda: now[0])
+        self.assertTrue(token.is_valid())
+
+        now[0] = 109.9
+        self.assertTrue(token.is_valid())
+
+        now[0] = 110.0
+        self.assertFalse(token.is_valid())
+
+    def test_should_expire_early_by_the_skew(self):
+        now = [100.0]
+        token = Token('access_token', expires_in=10, clock=lambda: now[0],
+                      skew=2)
+
+        now[0] = 107.9
+        self.assertTrue(token.is_valid())
+        now[0] = 108.0
+        self.assertFalse(token.is_valid())
+
+    def test_skew_should_be_capped_at_half_the_lifetime(self):
+        now = [100.0]
+        token = Token('access_token', expires_in=10, clock=lambda: now[0],
+                      skew=30)
+
+        now[0] = 104.9
+        self.assertTrue(token.is_valid())
+        now[0] = 105.0
+        self.assertFalse(token.is_valid())
+
+    def test_should_be_usable_within_a_grace_period(self):
+        now = [100.0]
+        token = Token('access_token', expires_in=10, clock=lambda: now[0])
+
+        now[0] = 115.0
+        self.assertFalse(token.is_valid())
+        self.assertTrue(token.is_valid(grace=10))
+        self.assertFalse(token.is_valid(grace=5))
+
+    def test_should_report_remaining_lifetime(self):
+        now = [100.0]
+        token = Token('access_token', expires_in='10', clock=lambda: now[0])
+
+        now[0] = 104.0
+        self.assertEqual(token.expires_in, 6.0)
+
+    def test_should_decode_jwt_claims_once(self):
+        token = Token(make_jwt({'sub': 'client', 'exp': 2000000000}))
+
+        with mock.patch('aioalf.token.decode_jwt_claims') as decode:
+            decode.return_value = {'sub': 'client'}
+            self.assertEqual(token.claims, {'sub': 'client'})
+            self.assertEqual(token.claims, {'sub': 'client'})
+
+        decode.assert_called_once_with(token.access_token)
+
+    def test_should_accept_claims_already_decoded(self):
+        token = Token('opaque', claims=None)
+        self.assertIsNone(token.claims)
+
+    def test_should_not_accept_new_attributes(self):
+        token = Token('access_token')
+        with self.assertRaises(AttributeError):
+            token.other = 'value'
+
+
+class TestJWT(TestCase):
+
+    def test_should_decode_the_payload(self):
+        claims = {'sub': 'client', 'exp': 2000000000}
+        self.assertEqual(decode_jwt_claims(make_jwt(claims)), claims)
+
+    def test_should_ignore_opaque_tokens(self):
+        self.assertIsNone(decode_jwt_claims('opaque-token'))
+        self.assertIsNone(decode_jwt_claims('a.b.c'))
+
+    def test_should_ignore_non_object_payloads(self):
+        token = make_jwt(['not', 'an', 'object'])
+        self.assertIsNone(decode_jwt_claims(token))
+
+    def test_expires_in_should_come_from_exp(self):
+        self.assertEqual(jwt_expires_in({'exp': 1100}, now=1000), 100)
+
+    def test_expires_in_should_need_a_numeric_exp(self):
+        self.assertIsNone(jwt_expires_in(None))
+        self.assertIsNone(jwt_expires_in({'sub': 'client'}))
+        self.assertIsNone(jwt_expires_in({'exp': '1100'}))
+        self.assertIsNone(jwt_expires_in({'exp': True}))
+
 
 class TestTokenHTTPError(TestCase):
 
@@ -37,3 +140,50 @@ class TestTokenHTTPError(TestCase):
         self.assertEqual(
             str(err),
             'My Error, StatusCode: 401, Body: {"myError": true}')
+
+
+class TestMaskAuthorization(TestCase):
+
+    def test_should_keep_scheme_and_token_edges(self):
+        self.assertEqual(mask_authorization('Bearer abcdefghijkl'),
+                         'Bearer abcde<...>kl')
+
+    def test_should_match_the_token_filter(self):
+        value = 'Basic Y2xpZW50X2lkOmNsaWVudF9zZWNyZXQ='
+        matches = TOKEN_FILTER.match(value)
+
+        self.assertEqual(mask_authorization(value), '{}<...>{}'.format(
+            matches.group('start'), matches.group('end')))
+
+    def test_should_hide_short_credentials(self):
+        self.assertEqual(mask_authorization('Bearer abc'), 'Bearer <...>')
+        self.assertEqual(mask_authorization('secret'), '<...>')
+
+
+class TestLogRequest(TestCase):
+
+    def test_should_mask_authorization_header(self):
+        logger = mock.Mock()
+        logger.isEnabledFor.return_value = True
+
+        log_request(logger, 'GET', 'http://api', {
+            'Authorization': 'Bearer abcdefghijkl',
+            'Accept': 'text/plain',
+        })
+
+        logger.isEnabledFor.assert_called_once_with(logging.DEBUG)
+        logger.debug.assert_has_calls([
+            mock.call('Request: %s %s', 'GET', 'http://api'),
+            mock.call('Header %s: %s', 'Authorization', 'Bearer abcde<...>kl'),
+            mock.call('Header %s: %s', 'Accept', 'text/plain'),
+        ])
+
+    def test_should_do_nothing_when_debug_is_disabled(self):
+        logger = mock.Mock()
+        logger.isEnabledFor.return_value = False
+        headers = mock.MagicMock()
+
+        log_request(logger, 'GET', 'http://api', headers)
+
+        logger.debug.assert_not_called()
+        headers.items.assert_not_called()